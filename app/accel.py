@@ -0,0 +1,279 @@
+import argparse
+import functools
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import torch
+from transformers import StaticCache, StoppingCriteria, StoppingCriteriaList
+
+from app.model import MAX_NEW_TOKENS
+from app.scheduler import MAX_CONCURRENCY
+
+logger = logging.getLogger(__name__)
+
+# eager — обычный forward PyTorch, compile — статический KV-кэш и torch.compile
+DECODE_MODE = os.environ.get("LLM_DECODE_MODE", "eager")
+# Кэш скомпилированных графов Inductor между перезапусками
+COMPILE_CACHE_DIR = os.environ.get(
+    "LLM_COMPILE_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "lllm", "torch_compile")
+)
+# Длины промпта, до которых дополняется вход: на каждую длину — один скомпилированный граф
+PROMPT_BUCKETS = tuple(int(x) for x in os.environ.get("LLM_PROMPT_BUCKETS", "64,128,256,512,1024,2048").split(","))
+
+
+def accel_enabled():
+    return DECODE_MODE == "compile"
+
+
+def is_accelerated(model):
+    return getattr(model, "_lllm_accelerated", False)
+
+
+def eager_forward(model):
+    """Некомпилированный forward модели (для вызовов вне generate)"""
+    return getattr(model, "_lllm_eager_forward", model)
+
+
+def bucket_length(length):
+    """Наименьший бакет, вмещающий промпт (последний бакет — предел длины)"""
+    for bucket in PROMPT_BUCKETS:
+        if length <= bucket:
+            return bucket
+    return PROMPT_BUCKETS[-1]
+
+
+def pad_to_bucket(tokenizer, inputs):
+    """
+    Дополняет токенизированный промпт слева до длины бакета, чтобы форма входа
+    совпадала с одной из скомпилированных
+    """
+    length = inputs["input_ids"].shape[1]
+    bucket = bucket_length(length)
+    if length == bucket:
+        return inputs
+    return tokenizer.pad(
+        {"input_ids": inputs["input_ids"].tolist(), "attention_mask": inputs["attention_mask"].tolist()},
+        padding="max_length",
+        max_length=bucket,
+        return_tensors="pt"
+    )
+
+
+def _enable_compile_cache():
+    os.makedirs(COMPILE_CACHE_DIR, exist_ok=True)
+    os.environ.setdefault("TORCHINDUCTOR_CACHE_DIR", COMPILE_CACHE_DIR)
+    os.environ.setdefault("TORCHINDUCTOR_FX_GRAPH_CACHE", "1")
+    os.environ.setdefault("TORCHINDUCTOR_AUTOGRAD_CACHE", "1")
+    try:
+        import torch._inductor.config as inductor_config
+        inductor_config.fx_graph_cache = True
+    except (ImportError, AttributeError):
+        pass
+
+
+class StaticCachePool:
+    """
+    Предвыделенные статические KV-кэши одной модели. Каждый вызов generate берет свой кэш,
+    поэтому параллельные запросы не перезаписывают друг другу KV. Размер у всех кэшей один
+    (последний бакет + max_new_tokens), и скомпилированные графы не зависят от длины запроса.
+    Свободными хранятся не больше max_free кэшей (по числу одновременно выполняемых запросов),
+    лишние освобождаются.
+    """
+
+    def __init__(self, model, max_cache_len, max_free=MAX_CONCURRENCY):
+        self.model = model
+        self.max_cache_len = max_cache_len
+        self.max_free = max_free
+        self.created = 0
+        self._free = []
+        self._lock = threading.Lock()
+
+    def new(self):
+        with self._lock:
+            self.created += 1
+        return StaticCache(
+            config=self.model.config,
+            max_batch_size=1,
+            max_cache_len=self.max_cache_len,
+            device=self.model.device,
+            dtype=self.model.dtype
+        )
+
+    def release(self, cache):
+        cache.reset()
+        with self._lock:
+            if len(self._free) < self.max_free:
+                self._free.append(cache)
+
+    @contextmanager
+    def acquire(self):
+        with self._lock:
+            cache = self._free.pop() if self._free else None
+        if cache is None:
+            cache = self.new()
+        try:
+            yield cache
+        finally:
+            self.release(cache)
+
+
+def kv_cache_tokens(model, total_tokens):
+    """
+    Сколько позиций KV-кэша занимает запрос длиной total_tokens: в ускоренном режиме
+    кэш из пула всегда полного размера
+    """
+    if is_accelerated(model):
+        return max(total_tokens, model._lllm_cache_pool.max_cache_len)
+    return total_tokens
+
+
+def _generate_with_pool(generate, pool):
+    @functools.wraps(generate)
+    def wrapper(*args, **kwargs):
+        if kwargs.get("past_key_values") is not None:
+            return generate(*args, **kwargs)
+        with pool.acquire() as cache:
+            return generate(*args, past_key_values=cache, **kwargs)
+    return wrapper
+
+
+def accelerate_model(model, tokenizer, max_new_tokens=MAX_NEW_TOKENS):
+    """
+    Включает статический предвыделенный KV-кэш и компилирует forward модели.
+    Граф компилируется лениво — при прогреве (warmup_compiled) на каждом бакете.
+    generate подменяется: каждый вызов берет собственный кэш из пула (батч из одного промпта).
+    """
+    if is_accelerated(model):
+        return model
+    _enable_compile_cache()
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+    tokenizer.padding_side = "left"
+    model._lllm_cache_pool = StaticCachePool(model, PROMPT_BUCKETS[-1] + max_new_tokens)
+    model.generate = _generate_with_pool(model.generate, model._lllm_cache_pool)
+    # Скоринг и прочие прямые вызовы идут в eager-forward, чтобы не компилировать лишние формы
+    model._lllm_eager_forward = model.forward
+    model.forward = torch.compile(model.forward, mode="reduce-overhead", fullgraph=True)
+    model._lllm_accelerated = True
+    logger.info(f"⚡ Ускоренный режим декодирования включен, кэш компиляции: {COMPILE_CACHE_DIR}")
+    return model
+
+
+class _StopAfter(StoppingCriteria):
+    """Останавливает генерацию на заданной длине, не меняя размер статического кэша"""
+
+    def __init__(self, length):
+        self.length = length
+
+    def __call__(self, input_ids, scores, **kwargs):
+        done = input_ids.shape[1] >= self.length
+        return torch.full((input_ids.shape[0],), done, dtype=torch.bool, device=input_ids.device)
+
+
+def warmup_compiled(model, tokenizer, max_new_tokens, buckets=PROMPT_BUCKETS, steps=3):
+    """
+    Компилирует prefill и шаг декодирования для каждого бакета на кэшах того же фиксированного
+    размера, что и в боевых запросах; генерация обрывается через несколько шагов.
+    Prefill на новом и на уже использованном кэше — разные графы, поэтому каждый бакет
+    прогоняется дважды на одном кэше. Проверка отсутствия перекомпиляций: TORCH_LOGS=recompiles.
+    Кэши прогрева не возвращаются в пул: память под них не зарезервирована в бюджете.
+    """
+    pool = model._lllm_cache_pool
+    pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+    for bucket in buckets:
+        started = time.perf_counter()
+        input_ids = torch.full((1, bucket), pad_token_id, dtype=torch.long, device=model.device)
+        attention_mask = torch.ones_like(input_ids)
+        cache = pool.new()
+        for _ in range(2):
+            with torch.no_grad():
+                model.generate(
+                    input_ids=input_ids,
+                    attention_mask=attention_mask,
+                    max_new_tokens=max_new_tokens,
+                    do_sample=False,
+                    pad_token_id=pad_token_id,
+                    past_key_values=cache,
+                    stopping_criteria=StoppingCriteriaList([_StopAfter(bucket + steps)])
+                )
+            cache.reset()
+        del cache
+        logger.info(f"⚡ Бакет {bucket} прогрет за {time.perf_counter() - started:.1f} с")
+
+
+def _time_generate(model, inputs, new_tokens, max_new_tokens, pad_token_id, repeats):
+    # max_new_tokens не меняется между замерами, а фактическая длина ограничивается критерием остановки
+    prompt_len = inputs["input_ids"].shape[1]
+    timings = []
+    for _ in range(repeats):
+        started = time.perf_counter()
+        with torch.no_grad():
+            model.generate(
+                **inputs,
+                max_new_tokens=max_new_tokens,
+                min_new_tokens=new_tokens,
+                do_sample=False,
+                pad_token_id=pad_token_id,
+                stopping_criteria=StoppingCriteriaList([_StopAfter(prompt_len + new_tokens)])
+            )
+        timings.append(time.perf_counter() - started)
+    return min(timings)
+
+
+def per_token_latency_ms(model, tokenizer, text, new_tokens, max_new_tokens, repeats=3, bucketed=False):
+    """
+    Задержка на один токен декодирования: разница времени генерации new_tokens и одного токена
+    (prefill вычитается), деленная на число шагов
+    """
+    pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+    inputs = tokenizer(text, return_tensors="pt")
+    if bucketed:
+        inputs = pad_to_bucket(tokenizer, inputs)
+    inputs = inputs.to(model.device)
+    prefill = _time_generate(model, inputs, 1, max_new_tokens, pad_token_id, repeats)
+    full = _time_generate(model, inputs, new_tokens, max_new_tokens, pad_token_id, repeats)
+    return (full - prefill) / (new_tokens - 1) * 1000
+
+
+def benchmark(model_name=None, new_tokens=64, repeats=3, max_new_tokens=512):
+    """
+    Сравнивает задержку на токен в eager-режиме и в ускоренном режиме на одной модели
+    """
+    from app.model import DEFAULT_MODEL_NAME, load_model
+
+    model, tokenizer = load_model(model_name or DEFAULT_MODEL_NAME)
+    text = "System: Вы - полезный ассистент.\nUser: Расскажи интересный факт о космосе\nAssistant:"
+
+    max_new_tokens = max(max_new_tokens, new_tokens)
+    eager_ms = per_token_latency_ms(model, tokenizer, text, new_tokens, max_new_tokens, repeats)
+
+    accelerate_model(model, tokenizer, max_new_tokens)
+    bucket = bucket_length(tokenizer(text, return_tensors="pt")["input_ids"].shape[1])
+    started = time.perf_counter()
+    warmup_compiled(model, tokenizer, max_new_tokens, buckets=(bucket,))
+    warmup_s = time.perf_counter() - started
+    compiled_ms = per_token_latency_ms(model, tokenizer, text, new_tokens, max_new_tokens, repeats, bucketed=True)
+
+    return {
+        "model": getattr(model, "name_or_path", "unknown"),
+        "device": str(model.device),
+        "new_tokens": new_tokens,
+        "eager_ms_per_token": round(eager_ms, 3),
+        "compiled_ms_per_token": round(compiled_ms, 3),
+        "speedup": round(eager_ms / compiled_ms, 2) if compiled_ms > 0 else None,
+        "warmup_s": round(warmup_s, 1),
+        "compile_cache_dir": COMPILE_CACHE_DIR
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Бенчмарк задержки декодирования: eager против compile")
+    parser.add_argument("--model", default=None)
+    parser.add_argument("--new-tokens", type=int, default=64)
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+    print(json.dumps(benchmark(args.model, args.new_tokens, args.repeats), ensure_ascii=False, indent=2))
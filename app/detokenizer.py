@@ -0,0 +1,85 @@
+import queue
+
+from transformers.generation.streamers import BaseStreamer
+
+# Сколько токенов промпта берется как контекст для декодирования первых токенов ответа
+DETOKENIZE_LOOKBACK = 6
+
+
+class IncrementalDetokenizer:
+    """
+    Инкрементальное декодирование: на каждом шаге декодируется только короткое окно последних токенов,
+    а не вся последовательность. Текст отдается только целыми символами UTF-8 — пока byte-level BPE
+    токены не собрали многобайтовый символ (например, кириллицу), декодер ждет следующих токенов.
+    """
+
+    def __init__(self, tokenizer, prompt_ids=None, skip_special_tokens=True, lookback=DETOKENIZE_LOOKBACK):
+        self.tokenizer = tokenizer
+        self.skip_special_tokens = skip_special_tokens
+        # Хвост промпта нужен, чтобы правильно декодировать пробел в начале первого токена
+        self.ids = list(prompt_ids[-lookback:]) if prompt_ids is not None else []
+        self.prefix_offset = 0
+        self.read_offset = len(self.ids)
+        self.token_count = 0
+
+    def _decode(self, ids):
+        return self.tokenizer.decode(ids, skip_special_tokens=self.skip_special_tokens)
+
+    def add(self, token_ids):
+        """Добавляет новые токены и возвращает готовый к выдаче текст (возможно, пустой)"""
+        self.ids.extend(token_ids)
+        self.token_count += len(token_ids)
+        prefix_text = self._decode(self.ids[self.prefix_offset:self.read_offset])
+        new_text = self._decode(self.ids[self.prefix_offset:])
+        # U+FFFD в конце — незавершенный многобайтовый символ
+        if len(new_text) <= len(prefix_text) or new_text.endswith("\ufffd"):
+            return ""
+        self.prefix_offset = self.read_offset
+        self.read_offset = len(self.ids)
+        return new_text[len(prefix_text):]
+
+    def flush(self):
+        """Остаток текста в конце генерации, даже если последний символ не завершен"""
+        prefix_text = self._decode(self.ids[self.prefix_offset:self.read_offset])
+        new_text = self._decode(self.ids[self.prefix_offset:])
+        self.prefix_offset = self.read_offset = len(self.ids)
+        return new_text[len(prefix_text):]
+
+
+class DetokenizingStreamer(BaseStreamer):
+    """
+    Стример для model.generate: превращает новые токены в фрагменты текста через
+    IncrementalDetokenizer и отдает их итератором (генерация идет в отдельном потоке)
+    """
+
+    def __init__(self, tokenizer, prompt_ids, timeout=None):
+        self.detokenizer = IncrementalDetokenizer(tokenizer, prompt_ids)
+        self.timeout = timeout
+        self._queue = queue.Queue()
+        self._prompt_seen = False
+
+    def put(self, value):
+        # Первый вызов generate передает сам промпт
+        if not self._prompt_seen:
+            self._prompt_seen = True
+            return
+        text = self.detokenizer.add(value.reshape(-1).tolist())
+        if text:
+            self._queue.put(text)
+
+    def end(self):
+        text = self.detokenizer.flush()
+        if text:
+            self._queue.put(text)
+        self._queue.put(None)
+
+    @property
+    def token_count(self):
+        return self.detokenizer.token_count
+
+    def __iter__(self):
+        while True:
+            text = self._queue.get(timeout=self.timeout)
+            if text is None:
+                return
+            yield text
@@ -0,0 +1,159 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from contextlib import nullcontext
+
+import torch
+
+# Поддерживаемые способы пулинга и форматы векторов
+POOLING_MODES = ("mean", "last", "first")
+VECTOR_DTYPES = ("float32", "float16", "int8")
+
+EMBEDDING_BATCH_SIZE = int(os.environ.get("LLM_EMBEDDING_BATCH_SIZE", "16"))
+EMBEDDING_MAX_LENGTH = int(os.environ.get("LLM_EMBEDDING_MAX_LENGTH", "512"))
+EMBEDDING_CACHE_SIZE = int(os.environ.get("LLM_EMBEDDING_CACHE_SIZE", "4096"))
+
+
+class EmbeddingCache:
+    """
+    LRU-кэш эмбеддингов по хэшу текста (хранит float32-векторы)
+    """
+
+    def __init__(self, max_size=EMBEDDING_CACHE_SIZE):
+        self.max_size = max_size
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(model_name, pooling, normalize, text):
+        raw = f"{model_name}\x00{pooling}\x00{int(normalize)}\x00{text}"
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        with self._lock:
+            vector = self._items.get(key)
+            if vector is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return vector
+
+    def put(self, key, vector):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._items[key] = vector
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            return {"size": len(self._items), "max_size": self.max_size, "hits": self.hits, "misses": self.misses}
+
+
+embedding_cache = EmbeddingCache()
+
+
+def _backbone_hidden_states(model, inputs):
+    """
+    Последний слой скрытых состояний без вычисления lm_head
+    """
+    backbone = model.get_decoder() if hasattr(model, "get_decoder") else None
+    if backbone is not None:
+        return backbone(**inputs, use_cache=False).last_hidden_state
+    outputs = model(**inputs, output_hidden_states=True, use_cache=False)
+    return outputs.hidden_states[-1]
+
+
+def _pool(hidden, attention_mask, pooling):
+    mask = attention_mask.to(hidden.dtype).unsqueeze(-1)
+    if pooling == "mean":
+        summed = (hidden * mask).sum(dim=1)
+        return summed / mask.sum(dim=1).clamp(min=1.0)
+
+    # Индексы первого/последнего реального токена работают при любой стороне паддинга
+    positions = torch.arange(attention_mask.shape[1], device=attention_mask.device)
+    masked = attention_mask.bool()
+    if pooling == "last":
+        index = torch.where(masked, positions, torch.full_like(positions, -1)).max(dim=1).values
+    else:
+        index = torch.where(masked, positions, torch.full_like(positions, attention_mask.shape[1])).min(dim=1).values
+    return hidden[torch.arange(hidden.shape[0], device=hidden.device), index]
+
+
+def encode_batch(model, tokenizer, texts, pooling="mean", normalize=True, max_length=EMBEDDING_MAX_LENGTH,
+                 reserve=None):
+    """
+    Считает эмбеддинги для одного батча текстов, возвращает float32-тензор на CPU.
+    reserve(batch_size, seq_len) — необязательный контекстный менеджер допуска по памяти
+    """
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+    inputs = tokenizer(texts, return_tensors="pt", padding=True, truncation=True, max_length=max_length)
+    inputs = inputs.to(model.device)
+    batch_size, seq_len = inputs["input_ids"].shape
+    with reserve(batch_size, seq_len) if reserve is not None else nullcontext(), torch.no_grad():
+        hidden = _backbone_hidden_states(model, inputs)
+        pooled = _pool(hidden, inputs["attention_mask"], pooling).float()
+        if normalize:
+            pooled = torch.nn.functional.normalize(pooled, p=2, dim=-1)
+    return pooled.cpu()
+
+
+def length_batches(tokenizer, texts, batch_size=EMBEDDING_BATCH_SIZE, max_length=EMBEDDING_MAX_LENGTH):
+    """
+    Группирует индексы текстов в батчи похожей длины, чтобы не тратить вычисления на паддинг
+    """
+    lengths = [len(ids) for ids in tokenizer(texts, truncation=True, max_length=max_length)["input_ids"]]
+    order = sorted(range(len(texts)), key=lambda i: lengths[i])
+    return [order[start:start + batch_size] for start in range(0, len(order), batch_size)]
+
+
+def quantize(vectors, dtype):
+    """
+    Приводит float32-векторы к нужному формату ответа.
+    Для int8 используется симметричное квантование с масштабом на каждый вектор.
+    """
+    if dtype == "float32":
+        return vectors.tolist(), None
+    if dtype == "float16":
+        return vectors.half().tolist(), None
+    scales = vectors.abs().amax(dim=-1).clamp(min=1e-12) / 127.0
+    quantized = torch.round(vectors / scales.unsqueeze(-1)).clamp(-127, 127).to(torch.int8)
+    return quantized.tolist(), scales.tolist()
+
+
+def embed_texts(model, tokenizer, texts, model_name, pooling="mean", normalize=True, use_cache=True,
+                reserve=None):
+    """
+    Эмбеддинги для списка текстов: кэш по хэшу, затем батчи по длине для промахов.
+    Возвращает (float32-тензор [N, hidden], число попаданий в кэш)
+    """
+    results = [None] * len(texts)
+    keys = [EmbeddingCache.key(model_name, pooling, normalize, text) for text in texts]
+
+    missing = []
+    for i, key in enumerate(keys):
+        cached = embedding_cache.get(key) if use_cache else None
+        if cached is None:
+            missing.append(i)
+        else:
+            results[i] = cached
+
+    if missing:
+        missing_texts = [texts[i] for i in missing]
+        for batch in length_batches(tokenizer, missing_texts):
+            batch_texts = [missing_texts[j] for j in batch]
+            vectors = encode_batch(model, tokenizer, batch_texts, pooling, normalize, reserve=reserve)
+            for j, vector in zip(batch, vectors):
+                i = missing[j]
+                results[i] = vector.clone()
+                if use_cache:
+                    embedding_cache.put(keys[i], results[i])
+
+    return torch.stack(results), len(texts) - len(missing)
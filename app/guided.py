@@ -0,0 +1,559 @@
+import json
+import os
+import threading
+import weakref
+from collections import OrderedDict
+
+import torch
+from transformers import LogitsProcessor
+
+# Сколько скомпилированных схем держать в кэше
+GUIDE_CACHE_SIZE = int(os.environ.get("LLM_GUIDED_CACHE_SIZE", "32"))
+# Предел minItems: каждый обязательный элемент — отдельная копия грамматики элемента
+MAX_MIN_ITEMS = 32
+# Предел числа состояний НКА: размер автомата растет с вложенностью, minItems и anyOf,
+# и без предела небольшая схема может разрастись до миллионов состояний
+MAX_NFA_STATES = int(os.environ.get("LLM_GUIDED_MAX_STATES", "200000"))
+# Предел числа вариантов в одном anyOf/oneOf
+MAX_ALTERNATIVES = 64
+# Глубина вложенности для значений без схемы (type не указан, object без properties, json_object)
+ANY_VALUE_DEPTH = int(os.environ.get("LLM_GUIDED_ANY_DEPTH", "8"))
+
+DEAD = -1
+
+
+# --- Регулярная грамматика над байтами ---------------------------------------------
+
+class _Lit:
+    def __init__(self, data):
+        self.data = data
+
+
+class _Cls:
+    def __init__(self, chars):
+        self.chars = frozenset(chars)
+
+
+class _Seq:
+    def __init__(self, *items):
+        self.items = items
+
+
+class _Alt:
+    def __init__(self, *items):
+        self.items = items
+
+
+class _Star:
+    def __init__(self, item):
+        self.item = item
+
+
+class _Sep:
+    """item (sep item)* — один экземпляр item в автомате вместо двух"""
+
+    def __init__(self, item, sep):
+        self.item = item
+        self.sep = sep
+
+
+def _opt(item):
+    return _Alt(item, _Seq())
+
+
+def _plus(item):
+    return _Seq(item, _Star(item))
+
+
+def _lit(text):
+    return _Lit(text.encode("utf-8"))
+
+
+_DIGIT = _Cls(b"0123456789")
+_HEX = _Cls(b"0123456789abcdefABCDEF")
+_SPACE = _opt(_lit(" "))
+# Любые байты, кроме кавычки, обратного слэша и управляющих символов (UTF-8 проходит побайтно)
+_STRING_CHAR = _Cls(set(range(0x20, 0x100)) - {ord('"'), ord("\\")})
+_ESCAPE = _Seq(_lit("\\"), _Alt(_Cls(b'"\\/bfnrt'), _Seq(_lit("u"), _HEX, _HEX, _HEX, _HEX)))
+_STRING = _Seq(_lit('"'), _Star(_Alt(_STRING_CHAR, _ESCAPE)), _lit('"'))
+_INTEGER = _Seq(_opt(_lit("-")), _Alt(_lit("0"), _Seq(_Cls(b"123456789"), _Star(_DIGIT))))
+_NUMBER = _Seq(
+    _INTEGER,
+    _opt(_Seq(_lit("."), _plus(_DIGIT))),
+    _opt(_Seq(_Cls(b"eE"), _opt(_Cls(b"+-")), _plus(_DIGIT)))
+)
+_BOOLEAN = _Alt(_lit("true"), _lit("false"))
+_NULL = _lit("null")
+
+
+def _literal(value):
+    return _lit(json.dumps(value, ensure_ascii=False))
+
+
+_COMMA = _Seq(_lit(","), _SPACE)
+
+
+def _array(item, min_items=0):
+    """Массив из не менее чем min_items элементов: обязательные элементы, затем любое число еще"""
+    if min_items == 0:
+        return _Seq(_lit("["), _opt(_Sep(item, _COMMA)), _lit("]"))
+    required = [_Seq(item, _COMMA)] * (min_items - 1)
+    return _Seq(_lit("["), *required, _Sep(item, _COMMA), _lit("]"))
+
+
+def _any_object(depth):
+    member = _Seq(_STRING, _lit(":"), _SPACE, _any_value(depth - 1))
+    return _Seq(_lit("{"), _opt(_Sep(member, _COMMA)), _lit("}"))
+
+
+def _any_value(depth):
+    scalars = [_STRING, _NUMBER, _BOOLEAN, _NULL]
+    if depth <= 0:
+        return _Alt(*scalars)
+    return _Alt(*scalars, _array(_any_value(depth - 1)), _any_object(depth))
+
+
+def _object(properties, depth):
+    """
+    Свойства выводятся в порядке объявления и все сразу: такой объект валиден для схемы
+    при любом наборе required
+    """
+    parts = [_lit("{")]
+    for i, (name, schema) in enumerate(properties.items()):
+        if i:
+            parts.extend([_lit(","), _SPACE])
+        parts.extend([_literal(name), _lit(":"), _SPACE, schema_to_grammar(schema, depth)])
+    parts.append(_lit("}"))
+    return _Seq(*parts)
+
+
+def _schema_list(schema, key):
+    """Непустой список подсхем или значений (enum, anyOf, ...): пустой запретил бы любой вывод"""
+    items = schema[key]
+    if not isinstance(items, list) or not items:
+        raise ValueError(f"{key} должен быть непустым списком")
+    return items
+
+
+def schema_to_grammar(schema, depth=ANY_VALUE_DEPTH):
+    """
+    Переводит подмножество JSON Schema в регулярную грамматику над байтами.
+    Поддерживаются type (в том числе списком), properties, items, minItems, enum, const,
+    anyOf/oneOf; $ref и рекурсивные схемы не поддерживаются. Размер итогового автомата
+    проверяется при его построении (MAX_NFA_STATES).
+    Любая некорректная схема приводит к ValueError.
+    """
+    if not isinstance(schema, dict):
+        raise ValueError("Схема должна быть JSON-объектом")
+    if "$ref" in schema:
+        raise ValueError("$ref в схеме не поддерживается")
+    if "const" in schema:
+        return _literal(schema["const"])
+    if "enum" in schema:
+        return _Alt(*(_literal(value) for value in _schema_list(schema, "enum")))
+    for key in ("anyOf", "oneOf"):
+        if key in schema:
+            items = _schema_list(schema, key)
+            if len(items) > MAX_ALTERNATIVES:
+                raise ValueError(f"{key} может содержать не больше {MAX_ALTERNATIVES} схем")
+            return _Alt(*(schema_to_grammar(item, depth) for item in items))
+    if "allOf" in schema:
+        if len(_schema_list(schema, "allOf")) != 1:
+            raise ValueError("allOf поддерживается только с одной схемой")
+        return schema_to_grammar(schema["allOf"][0], depth)
+
+    schema_type = schema.get("type")
+    if isinstance(schema_type, list):
+        return _Alt(*(schema_to_grammar(dict(schema, type=item), depth) for item in _schema_list(schema, "type")))
+    if schema_type is None:
+        return _any_value(depth)
+    if schema_type == "string":
+        return _STRING
+    if schema_type == "integer":
+        return _INTEGER
+    if schema_type == "number":
+        return _NUMBER
+    if schema_type == "boolean":
+        return _BOOLEAN
+    if schema_type == "null":
+        return _NULL
+    if schema_type == "array":
+        items = schema.get("items")
+        item = schema_to_grammar(items, depth - 1) if items is not None else _any_value(depth - 1)
+        min_items = schema.get("minItems", 0)
+        if isinstance(min_items, bool) or not isinstance(min_items, int) or not 0 <= min_items <= MAX_MIN_ITEMS:
+            raise ValueError(f"minItems должен быть целым числом от 0 до {MAX_MIN_ITEMS}")
+        return _array(item, min_items)
+    if schema_type == "object":
+        properties = schema.get("properties")
+        if properties is not None and not isinstance(properties, dict):
+            raise ValueError("properties должен быть JSON-объектом")
+        if not properties:
+            return _any_object(max(depth, 1))
+        return _object(properties, depth - 1)
+    raise ValueError(f"Неподдерживаемый тип в схеме: {schema_type}")
+
+
+# --- Автомат ---------------------------------------------------------------------
+
+class _NFA:
+    """
+    НКА Томпсона: переходы по классам байтов и ε-переходы.
+    Построение прерывается с ValueError, как только состояний становится больше max_states
+    """
+
+    def __init__(self, grammar, max_states=MAX_NFA_STATES):
+        self.max_states = max_states
+        self.eps = []
+        self.edges = []
+        self.start = self._new()
+        self.final = self._build(grammar, self.start)
+
+    def _new(self):
+        if len(self.eps) >= self.max_states:
+            raise ValueError(f"Схема слишком сложная: автомат больше {self.max_states} состояний")
+        self.eps.append([])
+        self.edges.append([])
+        return len(self.eps) - 1
+
+    def _build(self, node, start):
+        if isinstance(node, _Lit):
+            state = start
+            for byte in node.data:
+                target = self._new()
+                self.edges[state].append((frozenset((byte,)), target))
+                state = target
+            return state
+        if isinstance(node, _Cls):
+            target = self._new()
+            self.edges[start].append((node.chars, target))
+            return target
+        if isinstance(node, _Seq):
+            state = start
+            for item in node.items:
+                state = self._build(item, state)
+            return state
+        if isinstance(node, _Alt):
+            end = self._new()
+            for item in node.items:
+                branch = self._new()
+                self.eps[start].append(branch)
+                self.eps[self._build(item, branch)].append(end)
+            return end
+        if isinstance(node, _Star):
+            end = self._new()
+            loop = self._new()
+            self.eps[start].extend([loop, end])
+            body_end = self._build(node.item, loop)
+            self.eps[body_end].extend([loop, end])
+            return end
+        if isinstance(node, _Sep):
+            # После каждого элемента можно закончить или через разделитель вернуться к началу элемента
+            loop = self._new()
+            self.eps[start].append(loop)
+            item_end = self._build(node.item, loop)
+            end = self._new()
+            self.eps[item_end].append(end)
+            self.eps[self._build(node.sep, item_end)].append(loop)
+            return end
+        raise TypeError(f"Неизвестный узел грамматики: {node!r}")
+
+    def closure(self, states):
+        stack = list(states)
+        seen = set(stack)
+        while stack:
+            for target in self.eps[stack.pop()]:
+                if target not in seen:
+                    seen.add(target)
+                    stack.append(target)
+        return frozenset(seen)
+
+
+class ByteDFA:
+    """
+    ДКА над байтами, который строится лениво (подмножества НКА вычисляются при первом переходе)
+    """
+
+    def __init__(self, grammar):
+        self._nfa = _NFA(grammar)
+        self._states = []
+        self._index = {}
+        self._transitions = []
+        self._lock = threading.Lock()
+        self.initial = self._state(self._nfa.closure([self._nfa.start]))
+
+    def _state(self, nfa_states):
+        state = self._index.get(nfa_states)
+        if state is None:
+            state = len(self._states)
+            self._states.append(nfa_states)
+            self._transitions.append({})
+            self._index[nfa_states] = state
+        return state
+
+    def step(self, state, byte):
+        target = self._transitions[state].get(byte)
+        if target is not None:
+            return target
+        with self._lock:
+            targets = [
+                target
+                for nfa_state in self._states[state]
+                for chars, target in self._nfa.edges[nfa_state]
+                if byte in chars
+            ]
+            target = self._state(self._nfa.closure(targets)) if targets else DEAD
+            self._transitions[state][byte] = target
+        return target
+
+    def walk(self, state, data):
+        for byte in data:
+            state = self.step(state, byte)
+            if state == DEAD:
+                return DEAD
+        return state
+
+    def is_accepting(self, state):
+        return state != DEAD and self._nfa.final in self._states[state]
+
+    @property
+    def num_states(self):
+        return len(self._states)
+
+
+# --- Словарь токенизатора ---------------------------------------------------------
+
+def _bytes_to_unicode():
+    """Таблица byte-level BPE (GPT-2/Qwen): байт → печатный символ"""
+    printable = list(range(ord("!"), ord("~") + 1)) + list(range(ord("¡"), ord("¬") + 1)) + list(range(ord("®"), ord("ÿ") + 1))
+    chars = printable[:]
+    extra = 0
+    for byte in range(256):
+        if byte not in printable:
+            printable.append(byte)
+            chars.append(256 + extra)
+            extra += 1
+    return dict(zip(printable, (chr(c) for c in chars)))
+
+
+_BYTE_DECODER = {char: byte for byte, char in _bytes_to_unicode().items()}
+_vocab_cache = weakref.WeakKeyDictionary()
+_vocab_lock = threading.Lock()
+
+
+class TokenVocabulary:
+    """
+    Байтовые строки всех обычных токенов. Для векторного обхода они же хранятся матрицей
+    columns[позиция, токен] (uint8, дополнена нулями) вместе с длинами и id токенов
+    """
+
+    def __init__(self, tokenizer):
+        skip = set(tokenizer.all_special_ids) | set(tokenizer.get_added_vocab().values())
+        vocab = tokenizer.get_vocab()
+        byte_level = any(token.startswith("Ġ") for token in vocab)
+
+        token_bytes = {}
+        for token, token_id in vocab.items():
+            if token_id in skip:
+                continue
+            data = self._decode(token, byte_level)
+            if data:
+                token_bytes[token_id] = data
+
+        self.token_bytes = token_bytes
+        self.ids = torch.tensor(list(token_bytes), dtype=torch.long)
+        self.lengths = torch.tensor([len(data) for data in token_bytes.values()], dtype=torch.long)
+        width = max(self.lengths.tolist(), default=0)
+        padded = b"".join(data.ljust(width, b"\0") for data in token_bytes.values())
+        self.columns = torch.frombuffer(bytearray(padded), dtype=torch.uint8).view(len(token_bytes), width).t().contiguous()
+        self.size = max(len(tokenizer), max(vocab.values()) + 1)
+
+    @staticmethod
+    def _decode(token, byte_level):
+        if byte_level:
+            if all(char in _BYTE_DECODER for char in token):
+                return bytes(_BYTE_DECODER[char] for char in token)
+            return token.encode("utf-8")
+        # SentencePiece: ▁ — пробел, <0xNN> — отдельный байт
+        if len(token) == 6 and token.startswith("<0x") and token.endswith(">"):
+            return bytes([int(token[3:5], 16)])
+        return token.replace("▁", " ").encode("utf-8")
+
+
+def token_vocabulary(tokenizer):
+    with _vocab_lock:
+        vocabulary = _vocab_cache.get(tokenizer)
+        if vocabulary is None:
+            vocabulary = TokenVocabulary(tokenizer)
+            _vocab_cache[tokenizer] = vocabulary
+        return vocabulary
+
+
+# --- Маски токенов -----------------------------------------------------------------
+
+class SchemaGuide:
+    """
+    Скомпилированная схема для конкретного токенизатора: ДКА плюс маски допустимых токенов
+    для каждого состояния (считаются при первом посещении состояния и кэшируются).
+    Маска начального состояния, нужная каждому запросу, считается сразу при компиляции.
+    """
+
+    def __init__(self, schema, tokenizer, vocabulary=None):
+        self.dfa = ByteDFA(schema_to_grammar(schema))
+        self.vocabulary = vocabulary or token_vocabulary(tokenizer)
+        self.eos_token_id = tokenizer.eos_token_id
+        self._table = torch.empty((0, 256), dtype=torch.long)
+        self._filled = []
+        self._allowed = {}
+        self._masks = {}
+        self._lock = threading.Lock()
+        self.allowed_tokens(self.dfa.initial)
+
+    def _transition_table(self, states):
+        """
+        Плотная таблица переходов [состояние, байт] ДКА, в которой заполнены строки всех states
+        (строка считается один раз — 256 шагов ДКА)
+        """
+        with self._lock:
+            table = self._table
+            if table.shape[0] < self.dfa.num_states:
+                grown = torch.full((self.dfa.num_states * 2, 256), DEAD, dtype=torch.long)
+                grown[:table.shape[0]] = table
+                self._filled.extend([False] * (grown.shape[0] - table.shape[0]))
+                table = grown
+            for state in states:
+                if not self._filled[state]:
+                    table[state] = torch.tensor([self.dfa.step(state, byte) for byte in range(256)], dtype=torch.long)
+                    self._filled[state] = True
+            # Шаги ДКА могли добавить состояния, которые не помещаются в таблицу: их строки дозаполнит следующий вызов
+            self._table = table
+            return table
+
+    def allowed_tokens(self, state):
+        """Список токенов, после которых ДКА остаётся в живом состоянии"""
+        allowed = self._allowed.get(state)
+        if allowed is not None:
+            return allowed
+
+        # Все токены словаря продвигаются по ДКА одновременно, по одной позиции байта за шаг;
+        # переходы берутся из плотной таблицы, строки которой считаются для встреченных состояний
+        vocabulary = self.vocabulary
+        current = torch.full((len(vocabulary.ids),), state, dtype=torch.long)
+        live = torch.arange(len(vocabulary.ids))
+        for position in range(vocabulary.columns.shape[0]):
+            live = live[(current[live] != DEAD) & (vocabulary.lengths[live] > position)]
+            if not len(live):
+                break
+            states = current[live]
+            present = torch.zeros(self.dfa.num_states, dtype=torch.bool)
+            present[states] = True
+            table = self._transition_table(torch.nonzero(present).flatten().tolist())
+            current[live] = table[states, vocabulary.columns[position, live].long()]
+
+        allowed = vocabulary.ids[current != DEAD].tolist()
+        if self.dfa.is_accepting(state) and self.eos_token_id is not None:
+            allowed.append(self.eos_token_id)
+        self._allowed[state] = allowed
+        return allowed
+
+    def mask(self, state, size, device):
+        """Булева маска допустимых токенов размера size на нужном устройстве"""
+        key = (state, size, str(device))
+        mask = self._masks.get(key)
+        if mask is None:
+            mask = torch.zeros(size, dtype=torch.bool)
+            allowed = [token_id for token_id in self.allowed_tokens(state) if token_id < size]
+            if allowed:
+                mask[torch.tensor(allowed, dtype=torch.long)] = True
+            mask = mask.to(device)
+            with self._lock:
+                self._masks[key] = mask
+        return mask
+
+    def advance(self, state, token_id):
+        if state == DEAD or token_id == self.eos_token_id:
+            return state
+        data = self.vocabulary.token_bytes.get(token_id)
+        if data is None:
+            return DEAD
+        return self.dfa.walk(state, data)
+
+
+class JSONSchemaLogitsProcessor(LogitsProcessor):
+    """
+    Оставляет в логитах только токены, продолжающие допустимый по схеме JSON.
+    Состояние каждой строки батча продвигается по одному сгенерированному токену за шаг.
+    """
+
+    def __init__(self, guide):
+        self.guide = guide
+        self.states = None
+        self.seen = 0
+
+    def __call__(self, input_ids, scores):
+        if self.states is None:
+            self.states = [self.guide.dfa.initial] * input_ids.shape[0]
+        else:
+            for row, token_ids in enumerate(input_ids[:, self.seen:].tolist()):
+                for token_id in token_ids:
+                    self.states[row] = self.guide.advance(self.states[row], token_id)
+        self.seen = input_ids.shape[1]
+
+        size = scores.shape[-1]
+        for row, state in enumerate(self.states):
+            if state == DEAD:
+                allowed = torch.zeros(size, dtype=torch.bool, device=scores.device)
+                if self.guide.eos_token_id is not None:
+                    allowed[self.guide.eos_token_id] = True
+            else:
+                allowed = self.guide.mask(state, size, scores.device)
+            scores[row] = scores[row].masked_fill(~allowed, float("-inf"))
+        return scores
+
+
+# --- Кэш схем ----------------------------------------------------------------------
+
+_guides = OrderedDict()
+_guides_lock = threading.Lock()
+
+
+def schema_from_response_format(response_format):
+    """
+    Извлекает JSON Schema из response_format:
+    {"type": "json_schema", "json_schema": {"schema": {...}}}, {"type": "json_schema", "schema": {...}},
+    {"type": "json_object"} (любой JSON-объект) или сама схема
+    """
+    if not isinstance(response_format, dict):
+        raise ValueError("response_format должен быть JSON-объектом")
+    kind = response_format.get("type")
+    if kind == "json_object":
+        return {"type": "object"}
+    if kind == "json_schema":
+        wrapper = response_format.get("json_schema", response_format)
+        if not isinstance(wrapper, dict):
+            raise ValueError("json_schema должен быть JSON-объектом")
+        schema = wrapper.get("schema")
+        if schema is None:
+            raise ValueError("В response_format отсутствует schema")
+        return schema
+    return response_format
+
+
+def get_guide(schema, tokenizer):
+    """
+    Скомпилированная схема из LRU-кэша. Ключ — каноничный JSON схемы и словарь токенизатора:
+    кэш держит словарь живым, поэтому после выгрузки модели маски не достанутся чужому токенизатору
+    """
+    vocabulary = token_vocabulary(tokenizer)
+    key = (json.dumps(schema, sort_keys=True, ensure_ascii=False), vocabulary)
+    with _guides_lock:
+        guide = _guides.get(key)
+        if guide is not None:
+            _guides.move_to_end(key)
+            return guide
+    guide = SchemaGuide(schema, tokenizer, vocabulary)
+    with _guides_lock:
+        _guides[key] = guide
+        while len(_guides) > GUIDE_CACHE_SIZE:
+            _guides.popitem(last=False)
+    return guide
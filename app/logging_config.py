@@ -0,0 +1,177 @@
+import atexit
+import contextvars
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import time
+import uuid
+from contextlib import contextmanager
+
+LOG_LEVEL = os.environ.get("LLM_LOG_LEVEL", "INFO").upper()
+# json — одна JSON-запись на строку, text — человекочитаемый формат для локальной отладки
+LOG_FORMAT = os.environ.get("LLM_LOG_FORMAT", "json")
+# Доля запросов, для которых в лог попадает начало промпта
+LOG_PROMPT_SAMPLE_RATE = float(os.environ.get("LLM_LOG_PROMPT_SAMPLE_RATE", "0"))
+LOG_PROMPT_CHARS = int(os.environ.get("LLM_LOG_PROMPT_CHARS", "200"))
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+_listener = None
+_current_request = contextvars.ContextVar("request_log", default=None)
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Форматирует запись в одну JSON-строку; поля из extra={"fields": {...}} попадают на верхний уровень
+    """
+
+    def format(self, record):
+        payload = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage()
+        }
+        fields = getattr(record, "fields", None)
+        if fields:
+            payload.update(fields)
+        if record.exc_info:
+            payload["exc"] = self.formatException(record.exc_info)
+        return json.dumps(payload, ensure_ascii=False, default=str)
+
+
+def setup_logging(level=LOG_LEVEL, fmt=LOG_FORMAT):
+    """
+    Единая настройка логирования: корневой логгер пишет в очередь, а форматирование
+    и запись в stdout выполняет фоновый поток QueueListener. Повторный вызов ничего не делает.
+    """
+    global _listener
+    if _listener is not None:
+        return
+
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(JsonFormatter() if fmt == "json" else logging.Formatter(TEXT_FORMAT))
+
+    log_queue = queue.SimpleQueue()
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    root.setLevel(level)
+
+    # У логгеров uvicorn свои синхронные обработчики: ошибки сервера идут через общую очередь,
+    # а access-лог отключается — запись на каждый запрос пишет RequestLoggingMiddleware
+    for name in ("uvicorn", "uvicorn.error", "uvicorn.access"):
+        logging.getLogger(name).handlers.clear()
+    logging.getLogger("uvicorn").propagate = True
+    logging.getLogger("uvicorn.error").propagate = True
+    access = logging.getLogger("uvicorn.access")
+    access.propagate = False
+    access.disabled = True
+
+    _listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    _listener.start()
+    atexit.register(_listener.stop)
+
+
+class RequestLog:
+    """
+    Накопитель полей одного запроса: в лог уходит одна запись по завершении запроса
+    """
+
+    def __init__(self, request_id, method, path):
+        self.request_id = request_id
+        self.started = time.perf_counter()
+        self.fields = {"request_id": request_id, "method": method, "path": path}
+        self.stages = {}
+        self.sample_prompt = random.random() < LOG_PROMPT_SAMPLE_RATE
+
+    def set(self, **fields):
+        self.fields.update(fields)
+
+    @contextmanager
+    def stage(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = round((time.perf_counter() - started) * 1000, 2)
+
+    def prompt(self, text):
+        if self.sample_prompt:
+            self.fields["prompt"] = text[:LOG_PROMPT_CHARS]
+
+    def record(self, status):
+        fields = dict(self.fields, status=status, total_ms=round((time.perf_counter() - self.started) * 1000, 2))
+        if self.stages:
+            fields["stages_ms"] = self.stages
+        return fields
+
+
+def current_request():
+    """RequestLog текущего запроса или None вне HTTP-запроса"""
+    return _current_request.get()
+
+
+def log_fields(**fields):
+    request_log = _current_request.get()
+    if request_log is not None:
+        request_log.set(**fields)
+
+
+@contextmanager
+def log_stage(name):
+    request_log = _current_request.get()
+    if request_log is None:
+        yield
+        return
+    with request_log.stage(name):
+        yield
+
+
+def log_prompt(text):
+    request_log = _current_request.get()
+    if request_log is not None:
+        request_log.prompt(text)
+
+
+class RequestLoggingMiddleware:
+    """
+    ASGI-мидлварь: присваивает запросу id (из X-Request-ID или новый), возвращает его в заголовке
+    и пишет одну структурированную запись по завершении запроса
+    """
+
+    def __init__(self, app, logger_name="app.requests"):
+        self.app = app
+        self.logger = logging.getLogger(logger_name)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        request_id = None
+        for key, value in scope.get("headers", []):
+            if key == b"x-request-id":
+                request_id = value.decode("latin-1")
+                break
+        request_log = RequestLog(request_id or uuid.uuid4().hex, scope.get("method"), scope.get("path"))
+        token = _current_request.set(request_log)
+        status = 500
+
+        async def send_with_id(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                message["headers"] = list(message.get("headers", [])) + [(b"x-request-id", request_log.request_id.encode("latin-1"))]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_id)
+        finally:
+            _current_request.reset(token)
+            self.logger.info("request", extra={"fields": request_log.record(status)})
@@ -1,57 +1,141 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, Header, HTTPException, Request
 from pydantic import BaseModel
-from app.model import load_model, test_model_loading
-from fastapi.responses import HTMLResponse, JSONResponse
-from typing import Optional
+from app.model import MAX_NEW_TOKENS, test_model_loading
+from app.accel import accel_enabled, is_accelerated, kv_cache_tokens, pad_to_bucket
+from app.registry import UnknownModelError, model_registry
+from app.embeddings import POOLING_MODES, VECTOR_DTYPES, embed_texts, embedding_cache, quantize
+from app.scoring import SCORE_MAX_CANDIDATES, score_continuations
+from app.memory import MemoryBudgetExceeded, estimate_request_bytes, memory_governor
+from app.detokenizer import DetokenizingStreamer
+from app.guided import JSONSchemaLogitsProcessor, get_guide, schema_from_response_format
+from app.scheduler import (
+    ANONYMOUS_MAX_PRIORITY, PRIORITY_CLASSES, DEFAULT_PRIORITY, SchedulerRejected, api_key_tenant, cap_priority, scheduler
+)
+from app.logging_config import RequestLoggingMiddleware, log_fields, log_prompt, log_stage, setup_logging
+from app.recorder import RecordingMiddleware
+from fastapi.responses import HTMLResponse, JSONResponse, StreamingResponse
+from starlette.background import BackgroundTask
+from typing import Any, Dict, List, Optional
+from contextlib import ExitStack, contextmanager
+from transformers import LogitsProcessorList, StoppingCriteria, StoppingCriteriaList
+import json
+import hmac
 import traceback
+import anyio
 import torch
 import logging
-import sys
+import os
+import threading
 
 # Настройка логирования
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.StreamHandler(sys.stdout)
-    ]
-)
+setup_logging()
 logger = logging.getLogger(__name__)
 
 app = FastAPI(title="LLM API", description="API для работы с Qwen2.5-0.5B")
+# Запись трафика должна быть внутри мидлвари логирования, чтобы видеть поля RequestLog
+app.add_middleware(RecordingMiddleware)
+app.add_middleware(RequestLoggingMiddleware)
 
-# Ленивая загрузка модели
-model = None
-tokenizer = None
-model_info = {}
+# Реестр моделей с ленивой загрузкой (модель по умолчанию — app.model.DEFAULT_MODEL_NAME)
+def get_model(name=None):
+    """Возвращает ModelEntry (model, tokenizer, info) по имени, загружая модель при необходимости"""
+    try:
+        return model_registry.get(name)
+    except UnknownModelError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except Exception as e:
+        logger.error(f"❌ Ошибка загрузки модели: {str(e)}")
+        logger.error(f"📋 Полный трейсбек: {traceback.format_exc()}")
+        raise HTTPException(status_code=500, detail=f"Ошибка загрузки модели: {str(e)}")
 
-def get_model():
-    global model, tokenizer, model_info
-    if model is None or tokenizer is None:
-        try:
-            logger.info("🔄 Инициализация модели...")
-            model, tokenizer = load_model()
-            
-            # Сохраняем информацию о модели
-            model_info = {
-                "model_class": str(type(model).__name__),
-                "tokenizer_class": str(type(tokenizer).__name__),
-                "device": str(model.device) if hasattr(model, 'device') else "unknown",
-                "dtype": str(model.dtype) if hasattr(model, 'dtype') else "unknown",
-                "model_name": getattr(model, "name_or_path", "unknown"),
-                "vocab_size": tokenizer.vocab_size if hasattr(tokenizer, 'vocab_size') else "unknown"
-            }
-            logger.info(f"✅ Модель загружена: {model_info}")
-            
-        except Exception as e:
-            logger.error(f"❌ Ошибка загрузки модели: {str(e)}")
-            logger.error(f"📋 Полный трейсбек: {traceback.format_exc()}")
-            raise HTTPException(status_code=500, detail=f"Ошибка загрузки модели: {str(e)}")
-    return model, tokenizer
+def memory_reservation(model, batch_size, total_tokens, logits_positions=1, prefill_logits_positions=0):
+    """Резервирует бюджет памяти под запрос до начала вычислений"""
+    return memory_governor.reserve(
+        estimate_request_bytes(model, batch_size, total_tokens, logits_positions, prefill_logits_positions)
+    )
+
+def memory_exceeded_response(error):
+    """503 с Retry-After вместо падения процесса по OOM"""
+    return HTTPException(status_code=503, detail=str(error), headers={"Retry-After": "5"})
+
+def guided_logits_processor(schema, tokenizer):
+    """
+    Ограничение вывода JSON-схемой. Автомат схемы строится один раз и берется из кэша; построение
+    вызывается внутри слота планировщика, чтобы сложные схемы не компилировались вне очереди
+    """
+    try:
+        guide = get_guide(schema, tokenizer)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Некорректный response_format: {str(e)}")
+    return LogitsProcessorList([JSONSchemaLogitsProcessor(guide)])
+
+def tenant_of(http_request):
+    """
+    Клиент для справедливой очереди и его наивысший класс приоритета: по API-ключу из LLM_API_KEYS,
+    иначе по адресу клиента с классом не выше LLM_ANONYMOUS_MAX_PRIORITY
+    """
+    known = api_key_tenant(http_request.headers.get("x-api-key"))
+    if known is not None:
+        tenant, ceiling = known
+        return "key:" + tenant, ceiling
+    return "ip:" + (http_request.client.host if http_request.client else "unknown"), ANONYMOUS_MAX_PRIORITY
+
+@contextmanager
+def scheduling_slot(http_request, priority=None):
+    """
+    Ожидание слота выполнения в классе приоритета (поле priority или заголовок X-Priority);
+    класс выше разрешенного клиенту понижается
+    """
+    requested = priority or http_request.headers.get("x-priority") or DEFAULT_PRIORITY
+    if requested not in PRIORITY_CLASSES:
+        raise HTTPException(status_code=400, detail=f"priority должен быть одним из {PRIORITY_CLASSES}")
+    tenant, ceiling = tenant_of(http_request)
+    priority = cap_priority(requested, ceiling)
+    try:
+        with scheduler.slot(tenant, priority) as ticket:
+            log_fields(tenant=tenant, priority=priority, queue_ms=round(ticket.wait_s * 1000, 2))
+            yield
+    except SchedulerRejected as e:
+        log_fields(tenant=tenant, priority=priority, rejected=type(e).__name__)
+        raise HTTPException(status_code=e.status_code, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+
+def build_prompt(text, system_prompt):
+    """Простой шаблон диалога, общий для генерации и скоринга"""
+    return f"System: {system_prompt}\nUser: {text}\nAssistant:"
 
 class Prompt(BaseModel):
     text: str
     system_prompt: Optional[str] = "Вы - полезный ассистент, способный отвечать на различные вопросы."
+    # Имя модели из реестра; по умолчанию — модель по умолчанию
+    model: Optional[str] = None
+    # Ограничение вывода JSON-схемой: {"type": "json_schema", "json_schema": {"schema": {...}}} или {"type": "json_object"}
+    response_format: Optional[Dict[str, Any]] = None
+    # Класс приоритета: interactive, default или batch (можно передать и заголовком X-Priority)
+    priority: Optional[str] = None
+    # Потоковая выдача текста по мере генерации (text/plain)
+    stream: Optional[bool] = False
+
+class EmbeddingRequest(BaseModel):
+    input: List[str]
+    pooling: Optional[str] = "mean"
+    normalize: bool = True
+    encoding_format: Optional[str] = "float32"
+    use_cache: bool = True
+    model: Optional[str] = None
+    priority: Optional[str] = None
+
+class ScoreRequest(BaseModel):
+    prompt: str
+    continuations: List[str]
+    # Если задан, промпт оборачивается в тот же шаблон, что и в /generate
+    system_prompt: Optional[str] = None
+    model: Optional[str] = None
+    priority: Optional[str] = None
+
+class ModelLoadRequest(BaseModel):
+    name: str
+    model_id: str
+    warmup: Optional[bool] = True
 
 @app.get("/", response_class=HTMLResponse)
 def root():
@@ -75,6 +159,8 @@ def root():
                 <ul>
                     <li><a href="/health">/health</a> - Проверка здоровья API</li>
                     <li><a href="/model-info">/model-info</a> - Информация о модели</li>
+                    <li><a href="/memory">/memory</a> - Бюджет памяти и RSS</li>
+                    <li><a href="/scheduler/metrics">/scheduler/metrics</a> - Очереди по классам приоритета</li>
                     <li><a href="/test-model">/test-model</a> - Тест загрузки модели</li>
                     <li><a href="/docs">/docs</a> - OpenAPI документация</li>
                 </ul>
@@ -84,6 +170,9 @@ def root():
                 <h3>🚀 API эндпоинты:</h3>
                 <ul>
                     <li><code>POST /generate</code> - Генерация текста</li>
+                    <li><code>POST /embeddings</code> - Векторы предложений</li>
+                    <li><code>POST /score</code> - Лог-вероятности вариантов ответа</li>
+                    <li><code>GET /admin/models</code>, <code>POST /admin/models/load</code> - Реестр моделей</li>
                     <li><code>POST /simple-chat</code> - Простой тестовый чат</li>
                 </ul>
             </div>
@@ -96,11 +185,11 @@ def root():
 @app.get("/health")
 def health():
     try:
-        model, tokenizer = get_model()
+        entry = get_model()
         return {
             "status": "healthy", 
             "model_loaded": True,
-            "model_info": model_info,
+            "model_info": entry.info,
             "torch_version": torch.__version__,
             "cuda_available": torch.cuda.is_available(),
             "device_count": torch.cuda.device_count() if torch.cuda.is_available() else 0
@@ -119,9 +208,10 @@ def health():
 def model_info_endpoint():
     """Подробная информация о модели"""
     try:
-        model, tokenizer = get_model()
+        entry = get_model()
         return {
-            "model_info": model_info,
+            "model_info": entry.info,
+            "models": model_registry.list(),
             "transformers_version": __import__('transformers').__version__,
             "torch_version": torch.__version__,
             "device_info": {
@@ -133,6 +223,16 @@ def model_info_endpoint():
     except Exception as e:
         return {"error": str(e), "traceback": traceback.format_exc()}
 
+@app.get("/memory")
+def memory_endpoint():
+    """Зарезервированная бюджетом память против фактического RSS"""
+    return memory_governor.stats()
+
+@app.get("/scheduler/metrics")
+def scheduler_metrics():
+    """Очереди и время ожидания по классам приоритета"""
+    return scheduler.metrics()
+
 @app.get("/test-model")
 def test_model_endpoint():
     """Тестирование загрузки модели"""
@@ -142,71 +242,284 @@ def test_model_endpoint():
     except Exception as e:
         return {"test_passed": False, "error": str(e), "traceback": traceback.format_exc()}
 
+class CancelledCriteria(StoppingCriteria):
+    """Останавливает генерацию, когда клиент потокового ответа отключился"""
+
+    def __init__(self, cancelled):
+        self.cancelled = cancelled
+
+    def __call__(self, input_ids, scores, **kwargs):
+        done = self.cancelled.is_set()
+        return torch.full((input_ids.shape[0],), done, dtype=torch.bool, device=input_ids.device)
+
+def stream_generation(model, tokenizer, generation_kwargs, resources):
+    """
+    Генерация в отдельном потоке с инкрементальной детокенизацией: наружу отдаются только
+    новые целые символы, без повторного декодирования всей последовательности
+    """
+    streamer = DetokenizingStreamer(tokenizer, generation_kwargs["input_ids"][0].tolist())
+    cancelled = threading.Event()
+
+    def run():
+        try:
+            model.generate(
+                **generation_kwargs,
+                streamer=streamer,
+                stopping_criteria=StoppingCriteriaList([CancelledCriteria(cancelled)])
+            )
+        except Exception as e:
+            logger.error(f"❌ Ошибка потоковой генерации: {str(e)}")
+            logger.error(f"📋 Полный трейсбек: {traceback.format_exc()}")
+            streamer.end()
+
+    thread = threading.Thread(target=run, name="stream-generate", daemon=True)
+    thread.start()
+    try:
+        yield from streamer
+    finally:
+        cancelled.set()
+        thread.join()
+        resources.close()
+        log_fields(completion_tokens=streamer.token_count)
+
 @app.post("/generate")
-def generate(prompt: Prompt):
+def generate(prompt: Prompt, http_request: Request):
     """Генерация текста из текстового промпта"""
     try:
-        logger.info(f"📝 Получен запрос на генерацию: {prompt.text[:50]}...")
-        model, tokenizer = get_model()
+        entry = get_model(prompt.model)
+        model, tokenizer = entry.model, entry.tokenizer
         
         # Создаем простой промпт для генерации
-        input_text = f"System: {prompt.system_prompt}\nUser: {prompt.text}\nAssistant:"
-        logger.info(f"🔤 Промпт создан, длина: {len(input_text)}")
+        input_text = build_prompt(prompt.text, prompt.system_prompt)
+        log_prompt(prompt.text)
         
-        # Обрабатываем входы
-        logger.info("⚙️ Обработка входных данных...")
+        # response_format разбирается до очереди, а автомат схемы строится уже внутри слота
+        schema = None
+        if prompt.response_format is not None:
+            try:
+                schema = schema_from_response_format(prompt.response_format)
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=f"Некорректный response_format: {str(e)}")
         
-        # Проверяем тип токенизатора
-        if hasattr(tokenizer, 'tokenizer'):
-            # Это AutoTokenizer
-            inputs = tokenizer(input_text, return_tensors="pt", padding=True, truncation=True, max_length=2048)
-        else:
-            # Это AutoTokenizer
+        with log_stage("tokenize"):
             inputs = tokenizer(input_text, return_tensors="pt", padding=True, truncation=True, max_length=2048)
+            real_prompt_tokens = inputs["input_ids"].shape[1]
+            # В ускоренном режиме длина входа дополняется до скомпилированного бакета
+            if is_accelerated(model):
+                inputs = pad_to_bucket(tokenizer, inputs)
+            inputs = inputs.to(model.device)
         
-        inputs = inputs.to(model.device)
-        logger.info(f"📊 Входы подготовлены, устройство: {model.device}")
+        # Определяем pad_token_id для генерации
+        prompt_tokens = inputs["input_ids"].shape[1]
+        pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+        generation_kwargs = dict(
+            **inputs,
+            max_new_tokens=MAX_NEW_TOKENS,
+            do_sample=True,
+            temperature=0.7,
+            pad_token_id=pad_token_id,
+            eos_token_id=tokenizer.eos_token_id,
+            # Запрет повторов n-грамм несовместим с JSON (повторяются '", "' и т.п.)
+            no_repeat_ngram_size=0 if schema is not None else 3
+        )
+        log_fields(model=entry.name, prompt_tokens=real_prompt_tokens)
         
-        # Генерируем ответ
-        logger.info("🧠 Генерация ответа...")
-        with torch.no_grad():
-            # Определяем pad_token_id для генерации
-            pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
-            eos_token_id = tokenizer.eos_token_id
-            
-            output_ids = model.generate(
-                **inputs, 
-                max_new_tokens=512, 
-                do_sample=True, 
-                temperature=0.7,
-                pad_token_id=pad_token_id,
-                eos_token_id=eos_token_id,
-                no_repeat_ngram_size=3
+        if prompt.stream:
+            # Слот и память держатся до конца потоковой генерации и освобождаются генератором
+            with ExitStack() as resources:
+                resources.enter_context(scheduling_slot(http_request, prompt.priority))
+                resources.enter_context(memory_reservation(model, 1, kv_cache_tokens(model, prompt_tokens + MAX_NEW_TOKENS)))
+                if schema is not None:
+                    generation_kwargs["logits_processor"] = guided_logits_processor(schema, tokenizer)
+                resources = resources.pop_all()
+            # Фоновая задача страхует случай, когда ответ так и не начали читать (ExitStack.close идемпотентен)
+            return StreamingResponse(
+                stream_generation(model, tokenizer, generation_kwargs, resources),
+                media_type="text/plain; charset=utf-8",
+                background=BackgroundTask(resources.close)
             )
         
+        # Генерируем ответ
+        with scheduling_slot(http_request, prompt.priority), \
+                memory_reservation(model, 1, kv_cache_tokens(model, prompt_tokens + MAX_NEW_TOKENS)), \
+                log_stage("generate"), \
+                torch.no_grad():
+            if schema is not None:
+                generation_kwargs["logits_processor"] = guided_logits_processor(schema, tokenizer)
+            output_ids = model.generate(**generation_kwargs)
+        
         # Декодируем результат
-        logger.info("🔤 Декодирование результата...")
-        full_output = tokenizer.decode(output_ids[0], skip_special_tokens=True)
+        with log_stage("decode"):
+            if schema is not None:
+                generated_text = tokenizer.decode(output_ids[0, prompt_tokens:], skip_special_tokens=True)
+            else:
+                full_output = tokenizer.decode(output_ids[0], skip_special_tokens=True)
         
-        # Извлекаем только новый сгенерированный текст
-        if "Assistant:" in full_output:
-            generated_text = full_output.split("Assistant:")[-1].strip()
-        else:
-            generated_text = full_output[len(input_text):].strip()
+                # Извлекаем только новый сгенерированный текст
+                if "Assistant:" in full_output:
+                    generated_text = full_output.split("Assistant:")[-1].strip()
+                else:
+                    generated_text = full_output[len(input_text):].strip()
         
-        logger.info(f"✅ Генерация завершена, длина ответа: {len(generated_text)}")
-        return {"response": generated_text, "input_length": len(input_text), "output_length": len(generated_text)}
+        log_fields(completion_tokens=output_ids.shape[1] - prompt_tokens, output_chars=len(generated_text))
+        result = {
+            "response": generated_text,
+            "input_length": len(input_text),
+            "output_length": len(generated_text),
+            "model": entry.name
+        }
+        if schema is not None:
+            # JSON может быть неполным, только если закончился лимит MAX_NEW_TOKENS
+            try:
+                result["json"] = json.loads(generated_text)
+            except ValueError:
+                result["json"] = None
+        return result
         
+    except HTTPException:
+        raise
+    except MemoryBudgetExceeded as e:
+        log_fields(rejected="memory")
+        raise memory_exceeded_response(e)
     except Exception as e:
         logger.error(f"❌ Ошибка генерации: {str(e)}")
         logger.error(f"📋 Полный трейсбек: {traceback.format_exc()}")
         raise HTTPException(status_code=500, detail=f"Ошибка генерации: {str(e)}")
 
+@app.post("/embeddings")
+def embeddings(request: EmbeddingRequest, http_request: Request):
+    """Эмбеддинги текстов на скрытых состояниях уже загруженной модели"""
+    if not request.input:
+        raise HTTPException(status_code=400, detail="Список input пуст")
+    if request.pooling not in POOLING_MODES:
+        raise HTTPException(status_code=400, detail=f"pooling должен быть одним из {POOLING_MODES}")
+    if request.encoding_format not in VECTOR_DTYPES:
+        raise HTTPException(status_code=400, detail=f"encoding_format должен быть одним из {VECTOR_DTYPES}")
+    try:
+        entry = get_model(request.model)
+        model, tokenizer = entry.model, entry.tokenizer
+        with scheduling_slot(http_request, request.priority):
+            vectors, cache_hits = embed_texts(
+                model,
+                tokenizer,
+                request.input,
+                model_name=entry.model_id,
+                pooling=request.pooling,
+                normalize=request.normalize,
+                use_cache=request.use_cache,
+                reserve=lambda batch_size, seq_len: memory_reservation(model, batch_size, seq_len, 0)
+            )
+        log_fields(model=entry.name, inputs=len(request.input), cache_hits=cache_hits)
+        data, scales = quantize(vectors, request.encoding_format)
+        result = {
+            "data": [{"index": i, "embedding": vector} for i, vector in enumerate(data)],
+            "model": entry.name,
+            "model_id": entry.model_id,
+            "dimensions": vectors.shape[1],
+            "pooling": request.pooling,
+            "encoding_format": request.encoding_format,
+            "cache_hits": cache_hits
+        }
+        if scales is not None:
+            for item, scale in zip(result["data"], scales):
+                item["scale"] = scale
+        return result
+    except HTTPException:
+        raise
+    except MemoryBudgetExceeded as e:
+        raise memory_exceeded_response(e)
+    except Exception as e:
+        logger.error(f"❌ Ошибка построения эмбеддингов: {str(e)}")
+        logger.error(f"📋 Полный трейсбек: {traceback.format_exc()}")
+        raise HTTPException(status_code=500, detail=f"Ошибка построения эмбеддингов: {str(e)}")
+
+@app.get("/embeddings/cache")
+def embeddings_cache_stats():
+    """Статистика кэша эмбеддингов"""
+    return embedding_cache.stats()
+
+@app.post("/score")
+def score(request: ScoreRequest, http_request: Request):
+    """Ранжирование продолжений по лог-вероятности без генерации"""
+    if not request.continuations:
+        raise HTTPException(status_code=400, detail="Список continuations пуст")
+    if len(request.continuations) > SCORE_MAX_CANDIDATES:
+        raise HTTPException(status_code=400, detail=f"Не больше {SCORE_MAX_CANDIDATES} продолжений за запрос")
+    try:
+        entry = get_model(request.model)
+        model, tokenizer = entry.model, entry.tokenizer
+        prompt_text = request.prompt
+        if request.system_prompt is not None:
+            prompt_text = build_prompt(request.prompt, request.system_prompt)
+        with scheduling_slot(http_request, request.priority):
+            result = score_continuations(
+                model,
+                tokenizer,
+                prompt_text,
+                request.continuations,
+                reserve=lambda batch_size, total_tokens, logits_positions, prefill_logits_positions: memory_reservation(
+                    model, batch_size, total_tokens, logits_positions, prefill_logits_positions
+                )
+            )
+        log_fields(model=entry.name, prompt_tokens=result["prompt_tokens"], candidates=len(request.continuations))
+        result["ranking"] = [
+            item["index"] for item in sorted(result["candidates"], key=lambda item: item["total_logprob"], reverse=True)
+        ]
+        return result
+    except HTTPException:
+        raise
+    except MemoryBudgetExceeded as e:
+        raise memory_exceeded_response(e)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.error(f"❌ Ошибка скоринга: {str(e)}")
+        logger.error(f"📋 Полный трейсбек: {traceback.format_exc()}")
+        raise HTTPException(status_code=500, detail=f"Ошибка скоринга: {str(e)}")
+
+# Токен для административных эндпоинтов; если не задан, они отключены
+ADMIN_TOKEN = os.environ.get("LLM_ADMIN_TOKEN")
+
+def check_admin(token):
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Административные эндпоинты отключены: не задан LLM_ADMIN_TOKEN")
+    if token is None or not hmac.compare_digest(token.encode("utf-8"), ADMIN_TOKEN.encode("utf-8")):
+        raise HTTPException(status_code=403, detail="Неверный X-Admin-Token")
+
+@app.get("/admin/models")
+def admin_list_models(x_admin_token: Optional[str] = Header(None)):
+    """Модели реестра, их состояние и фоновые загрузки"""
+    check_admin(x_admin_token)
+    return model_registry.list()
+
+@app.post("/admin/models/load", status_code=202)
+def admin_load_model(request: ModelLoadRequest, x_admin_token: Optional[str] = Header(None)):
+    """Фоновая загрузка модели и атомарное переключение трафика после прогрева"""
+    check_admin(x_admin_token)
+    # Загрузка выполняет код из репозитория модели (trust_remote_code), поэтому только из списка разрешенных
+    if not model_registry.is_allowed(request.model_id):
+        raise HTTPException(status_code=403, detail=f"Модель '{request.model_id}' не входит в LLM_MODELS/LLM_ALLOWED_MODELS")
+    try:
+        job = model_registry.load_async(request.name, request.model_id, warmup=request.warmup)
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    logger.info(f"📥 Фоновая загрузка '{request.name}' ({request.model_id}) запущена")
+    return {"name": request.name, **job}
+
+@app.delete("/admin/models/{name}")
+def admin_unload_model(name: str, x_admin_token: Optional[str] = Header(None)):
+    """Выгрузка модели из памяти (при следующем обращении она загрузится снова)"""
+    check_admin(x_admin_token)
+    try:
+        return {"name": name, "unloaded": model_registry.unload(name)}
+    except UnknownModelError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
 @app.post("/simple-chat")
 def simple_chat(prompt: Prompt):
     """Упрощенный чат для тестирования"""
     try:
-        logger.info(f"💬 Простой чат: {prompt.text}")
+        log_prompt(prompt.text)
         return {
             "response": f"Простой тестовый ответ на: '{prompt.text}'. API работает! 🎉", 
             "status": "test_mode",
@@ -216,11 +529,29 @@ def simple_chat(prompt: Prompt):
         logger.error(f"❌ Ошибка в простом чате: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Ошибка: {str(e)}")
 
+# Размер пула потоков для синхронных эндпоинтов
+THREADPOOL_SIZE = int(os.environ.get("LLM_THREADPOOL_SIZE", "200"))
+# Потоки, которые очередь планировщика не может занять: /health, метрики, админка
+THREADPOOL_RESERVE = 32
+
 # Добавляем startup event для предварительной загрузки модели
+
 @app.on_event("startup")
 async def startup_event():
     logger.info("🚀 Запуск API...")
     logger.info("ℹ️ Модель будет загружена при первом запросе")
+    # Ожидающие в очереди запросы занимают потоки пула, поэтому очередь ограничена так,
+    # чтобы остальным эндпоинтам всегда оставались свободные потоки (сверх очереди — 429)
+    anyio.to_thread.current_default_thread_limiter().total_tokens = THREADPOOL_SIZE
+    queue_capacity = max(1, THREADPOOL_SIZE - scheduler.max_concurrency - THREADPOOL_RESERVE)
+    if scheduler.max_queued > queue_capacity:
+        logger.warning(f"⚠️ LLM_MAX_QUEUED={scheduler.max_queued} не помещается в пул из {THREADPOOL_SIZE} потоков, очередь уменьшена до {queue_capacity}")
+        scheduler.max_queued = queue_capacity
+    model_registry.start_sweeper()
+    if accel_enabled():
+        # Компиляция занимает время, поэтому модель по умолчанию грузится и прогревается сразу
+        logger.info("⚡ Ускоренный режим: прогрев модели по умолчанию в фоне")
+        threading.Thread(target=model_registry.get, name="model-warmup", daemon=True).start()
 
 @app.on_event("shutdown")
 async def shutdown_event():
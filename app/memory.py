@@ -0,0 +1,140 @@
+import os
+import resource
+import threading
+import time
+from contextlib import contextmanager
+
+import torch
+
+# Бюджет памяти под KV-кэш и активации запросов; 0 — без ограничения
+MEMORY_BUDGET_MB = float(os.environ.get("LLM_MEMORY_BUDGET_MB", "0"))
+# Сколько запрос может ждать освобождения бюджета, прежде чем получить отказ
+MEMORY_WAIT_TIMEOUT_S = float(os.environ.get("LLM_MEMORY_WAIT_TIMEOUT_S", "30"))
+
+
+class MemoryBudgetExceeded(Exception):
+    """Запрос не помещается в бюджет памяти"""
+
+
+def current_rss_bytes():
+    """
+    Текущий RSS процесса (через /proc, с запасным вариантом через пиковый maxrss)
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        # ru_maxrss в килобайтах на Linux; это пик, а не текущее значение
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def kv_bytes_per_token(model):
+    """
+    Размер KV-кэша на один токен: 2 (K и V) × слои × KV-головы × размер головы × байты типа
+    """
+    config = model.config
+    num_layers = config.num_hidden_layers
+    num_heads = config.num_attention_heads
+    num_kv_heads = getattr(config, "num_key_value_heads", None) or num_heads
+    head_dim = getattr(config, "head_dim", None) or config.hidden_size // num_heads
+    dtype = model.dtype if isinstance(model.dtype, torch.dtype) else torch.float32
+    dtype_bytes = torch.finfo(dtype).bits // 8 if dtype.is_floating_point else 4
+    return 2 * num_layers * num_kv_heads * head_dim * dtype_bytes
+
+
+def estimate_request_bytes(model, batch_size, total_tokens, logits_positions=1, prefill_logits_positions=0):
+    """
+    Оценка памяти запроса: KV-кэш на всю длину плюс логиты в float32
+    (при генерации логиты считаются только для последней позиции).
+    prefill_logits_positions — логиты отдельного прохода по общему промпту, живущие одновременно с основными
+    """
+    kv = kv_bytes_per_token(model) * batch_size * total_tokens
+    logits = (batch_size * logits_positions + prefill_logits_positions) * model.config.vocab_size * 4
+    return kv + logits
+
+
+class MemoryGovernor:
+    """
+    Допуск запросов по оценке памяти: запрос резервирует бюджет до начала вычислений,
+    ждёт, пока бюджет освободится, или получает отказ
+    """
+
+    def __init__(self, budget_bytes, wait_timeout=MEMORY_WAIT_TIMEOUT_S):
+        self.budget_bytes = int(budget_bytes)
+        self.wait_timeout = wait_timeout
+        self.reserved_bytes = 0
+        self.active = 0
+        self.waiting = 0
+        self.admitted_total = 0
+        self.rejected_total = 0
+        self.peak_reserved_bytes = 0
+        self._cond = threading.Condition()
+
+    @property
+    def enabled(self):
+        return self.budget_bytes > 0
+
+    @contextmanager
+    def reserve(self, nbytes):
+        """
+        Резервирует nbytes на время блока with; бросает MemoryBudgetExceeded при невозможности
+        """
+        nbytes = int(nbytes)
+        if not self.enabled:
+            yield
+            return
+
+        with self._cond:
+            if nbytes > self.budget_bytes:
+                self.rejected_total += 1
+                raise MemoryBudgetExceeded(
+                    f"Запросу нужно ~{nbytes / 2**20:.0f} МБ, бюджет {self.budget_bytes / 2**20:.0f} МБ"
+                )
+            deadline = time.monotonic() + self.wait_timeout
+            self.waiting += 1
+            try:
+                while self.reserved_bytes + nbytes > self.budget_bytes:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.rejected_total += 1
+                        raise MemoryBudgetExceeded(
+                            f"Бюджет памяти занят: нужно ~{nbytes / 2**20:.0f} МБ, "
+                            f"свободно {(self.budget_bytes - self.reserved_bytes) / 2**20:.0f} МБ"
+                        )
+                    self._cond.wait(remaining)
+            finally:
+                self.waiting -= 1
+            self.reserved_bytes += nbytes
+            self.active += 1
+            self.admitted_total += 1
+            self.peak_reserved_bytes = max(self.peak_reserved_bytes, self.reserved_bytes)
+
+        try:
+            yield
+        finally:
+            with self._cond:
+                self.reserved_bytes -= nbytes
+                self.active -= 1
+                self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            stats = {
+                "enabled": self.enabled,
+                "budget_mb": self.budget_bytes / 2**20,
+                "reserved_mb": self.reserved_bytes / 2**20,
+                "peak_reserved_mb": self.peak_reserved_bytes / 2**20,
+                "active_requests": self.active,
+                "waiting_requests": self.waiting,
+                "admitted_total": self.admitted_total,
+                "rejected_total": self.rejected_total
+            }
+        stats["rss_mb"] = current_rss_bytes() / 2**20
+        if torch.cuda.is_available():
+            stats["cuda_allocated_mb"] = torch.cuda.memory_allocated() / 2**20
+            stats["cuda_reserved_mb"] = torch.cuda.memory_reserved() / 2**20
+        return stats
+
+
+memory_governor = MemoryGovernor(MEMORY_BUDGET_MB * 2**20)
@@ -1,16 +1,20 @@
 from transformers import AutoProcessor, AutoModelForCausalLM, AutoTokenizer
 import torch
 import logging
+import os
 
-# Настройка логирования
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-def load_model():
+# Модель по умолчанию; переопределяется через LLM_MODEL_NAME
+DEFAULT_MODEL_NAME = os.environ.get("LLM_MODEL_NAME", "Qwen/Qwen2.5-0.5B-Instruct")
+
+# Максимум новых токенов при генерации (учитывается в оценке памяти и в размере статического кэша)
+MAX_NEW_TOKENS = 512
+
+def load_model(model_name=DEFAULT_MODEL_NAME):
     """
-    Загружает только модель Qwen2.5-0.5B-Instruct, без fallback
+    Загружает указанную модель (по умолчанию Qwen2.5-0.5B-Instruct), без fallback
     """
-    model_name = "Qwen/Qwen2.5-0.5B-Instruct"
     
     try:
         logger.info(f"🔄 Загрузка модели: {model_name}")
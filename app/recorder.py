@@ -0,0 +1,192 @@
+import atexit
+import hashlib
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import time
+
+from app.logging_config import current_request
+
+# Файл журнала трафика; пустое значение — запись выключена
+RECORD_PATH = os.environ.get("LLM_RECORD_PATH", "")
+RECORD_SAMPLE_RATE = float(os.environ.get("LLM_RECORD_SAMPLE_RATE", "1.0"))
+# По умолчанию тексты не сохраняются: только хэш и длина
+RECORD_REDACT = os.environ.get("LLM_RECORD_REDACT", "1").lower() not in ("0", "false", "no")
+RECORD_MAX_BYTES = int(os.environ.get("LLM_RECORD_MAX_MB", "50")) * 2**20
+RECORD_BACKUPS = int(os.environ.get("LLM_RECORD_BACKUPS", "5"))
+
+RECORDED_PATHS = ("/generate", "/embeddings", "/score")
+# Поля тела запроса, содержащие пользовательский текст
+TEXT_FIELDS = ("text", "system_prompt", "prompt", "input", "continuations")
+# Заголовки, влияющие на обслуживание запроса (API-ключ не сохраняется)
+RECORDED_HEADERS = (b"x-priority",)
+# Ответы длиннее этого не разбираются для сравнения вывода (например, большие эмбеддинги)
+RESPONSE_CAPTURE_LIMIT = 2**20
+
+
+def text_hash(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()[:16]
+
+
+def _redact_value(value):
+    if isinstance(value, str):
+        return {"redacted": True, "sha": text_hash(value), "len": len(value)}
+    if isinstance(value, list):
+        return [_redact_value(item) for item in value]
+    return value
+
+
+def redact_body(body):
+    """Заменяет пользовательский текст в теле запроса на хэш и длину"""
+    return {key: _redact_value(value) if key in TEXT_FIELDS else value for key, value in body.items()}
+
+
+def summarize_response(content_type, data):
+    """
+    Компактная сводка ответа для сравнения вывода при воспроизведении:
+    хэш и длина текста ответа либо ранжирование кандидатов
+    """
+    if data is None:
+        return None
+    text = data.decode("utf-8", errors="replace")
+    if content_type.startswith("text/plain"):
+        return {"sha": text_hash(text), "len": len(text)}
+    try:
+        payload = json.loads(text)
+    except ValueError:
+        return None
+    if not isinstance(payload, dict):
+        return None
+    if "response" in payload:
+        return {"sha": text_hash(payload["response"]), "len": len(payload["response"])}
+    if "ranking" in payload:
+        return {"ranking": payload["ranking"]}
+    if "data" in payload:
+        return {"items": len(payload["data"])}
+    return None
+
+
+class TrafficRecorder:
+    """
+    Журнал реального трафика: сэмплированные параметры запросов, число токенов и времена этапов.
+    Запись идет через очередь в отдельный ротируемый файл, одна компактная JSON-строка на запрос.
+    """
+
+    def __init__(self, path=RECORD_PATH, sample_rate=RECORD_SAMPLE_RATE, redact=RECORD_REDACT,
+                 max_bytes=RECORD_MAX_BYTES, backups=RECORD_BACKUPS):
+        self.path = path
+        self.sample_rate = sample_rate
+        self.redact = redact
+        self._logger = None
+        if not path:
+            return
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        file_handler = logging.handlers.RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backups, encoding="utf-8")
+        file_handler.setFormatter(logging.Formatter("%(message)s"))
+        record_queue = queue.SimpleQueue()
+        self._listener = logging.handlers.QueueListener(record_queue, file_handler)
+        self._listener.start()
+        atexit.register(self._listener.stop)
+
+        self._logger = logging.getLogger("app.recorder")
+        self._logger.propagate = False
+        self._logger.setLevel(logging.INFO)
+        self._logger.addHandler(logging.handlers.QueueHandler(record_queue))
+
+    @property
+    def enabled(self):
+        return self._logger is not None
+
+    def sampled(self):
+        return self.enabled and random.random() < self.sample_rate
+
+    def write(self, record):
+        self._logger.info(json.dumps(record, ensure_ascii=False, separators=(",", ":")))
+
+
+recorder = TrafficRecorder()
+
+
+class RecordingMiddleware:
+    """
+    ASGI-мидлварь записи трафика: сохраняет тело запроса, статус, задержку, поля RequestLog
+    (токены, этапы) и сводку ответа. Должна стоять внутри RequestLoggingMiddleware.
+    """
+
+    def __init__(self, app, traffic_recorder=recorder):
+        self.app = app
+        self.recorder = traffic_recorder
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope.get("path") not in RECORDED_PATHS or not self.recorder.sampled():
+            await self.app(scope, receive, send)
+            return
+
+        arrived = time.time()
+        started = time.perf_counter()
+        request_chunks = []
+        response = {"status": 500, "content_type": "", "chunks": [], "size": 0}
+
+        async def receive_and_capture():
+            message = await receive()
+            if message["type"] == "http.request":
+                request_chunks.append(message.get("body", b""))
+            return message
+
+        async def send_and_capture(message):
+            if message["type"] == "http.response.start":
+                response["status"] = message["status"]
+                for key, value in message.get("headers", []):
+                    if key == b"content-type":
+                        response["content_type"] = value.decode("latin-1")
+            elif message["type"] == "http.response.body":
+                body = message.get("body", b"")
+                response["size"] += len(body)
+                if response["size"] <= RESPONSE_CAPTURE_LIMIT:
+                    response["chunks"].append(body)
+            await send(message)
+
+        try:
+            await self.app(scope, receive_and_capture, send_and_capture)
+        finally:
+            self._write(scope, arrived, started, b"".join(request_chunks), response)
+
+    def _write(self, scope, arrived, started, request_body, response):
+        try:
+            body = json.loads(request_body or b"{}")
+        except ValueError:
+            body = None
+        if isinstance(body, dict) and self.recorder.redact:
+            body = redact_body(body)
+
+        record = {
+            "t": round(arrived, 3),
+            "path": scope["path"],
+            "status": response["status"],
+            "ms": round((time.perf_counter() - started) * 1000, 2),
+            "body": body
+        }
+        headers = {
+            key.decode("latin-1"): value.decode("latin-1")
+            for key, value in scope.get("headers", []) if key in RECORDED_HEADERS
+        }
+        if headers:
+            record["headers"] = headers
+
+        request_log = current_request()
+        if request_log is not None:
+            for field in ("prompt_tokens", "completion_tokens", "queue_ms", "tenant", "priority"):
+                if field in request_log.fields:
+                    record[field] = request_log.fields[field]
+            if request_log.stages:
+                record["stages_ms"] = dict(request_log.stages)
+
+        captured = b"".join(response["chunks"]) if response["size"] <= RESPONSE_CAPTURE_LIMIT else None
+        output = summarize_response(response["content_type"], captured) if response["status"] == 200 else None
+        if output is not None:
+            record["output"] = output
+        self.recorder.write(record)
@@ -0,0 +1,289 @@
+import logging
+import os
+import threading
+import time
+
+import torch
+
+from app.accel import accel_enabled, accelerate_model, is_accelerated, warmup_compiled
+from app.model import DEFAULT_MODEL_NAME, MAX_NEW_TOKENS, load_model
+
+logger = logging.getLogger(__name__)
+
+# Имя модели, на которую идут запросы без явного выбора
+DEFAULT_ALIAS = os.environ.get("LLM_DEFAULT_MODEL", "default")
+# Дополнительные модели: "имя=repo_id,имя2=repo_id2"
+EXTRA_MODELS = os.environ.get("LLM_MODELS", "")
+# Какие еще model_id разрешено загружать через /admin/models/load (кроме зарегистрированных): "repo_id,repo_id2"
+ALLOWED_MODELS = os.environ.get("LLM_ALLOWED_MODELS", "")
+# Через сколько секунд простоя модель выгружается (кроме модели по умолчанию); 0 — никогда
+MODEL_IDLE_TTL_S = float(os.environ.get("LLM_MODEL_IDLE_TTL_S", "0"))
+# Предел суммарного размера весов загруженных моделей; 0 — без ограничения
+MODEL_MEMORY_CAP_MB = float(os.environ.get("LLM_MODEL_MEMORY_CAP_MB", "0"))
+
+
+class UnknownModelError(Exception):
+    """Запрошена модель, которой нет в реестре"""
+
+
+def model_size_bytes(model):
+    return sum(p.numel() * p.element_size() for p in model.parameters())
+
+
+def describe_model(model, tokenizer):
+    """
+    Сводная информация о модели для диагностических эндпоинтов
+    """
+    return {
+        "model_class": str(type(model).__name__),
+        "tokenizer_class": str(type(tokenizer).__name__),
+        "device": str(model.device) if hasattr(model, 'device') else "unknown",
+        "dtype": str(model.dtype) if hasattr(model, 'dtype') else "unknown",
+        "model_name": getattr(model, "name_or_path", "unknown"),
+        "vocab_size": tokenizer.vocab_size if hasattr(tokenizer, 'vocab_size') else "unknown",
+        "decode_mode": "compile" if is_accelerated(model) else "eager"
+    }
+
+
+def warmup_model(model, tokenizer):
+    """
+    Короткая генерация, чтобы первый настоящий запрос не платил за инициализацию
+    (в ускоренном режиме — компиляция всех бакетов)
+    """
+    if is_accelerated(model):
+        warmup_compiled(model, tokenizer, MAX_NEW_TOKENS)
+        return
+    inputs = tokenizer("Привет!", return_tensors="pt").to(model.device)
+    pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+    with torch.no_grad():
+        model.generate(**inputs, max_new_tokens=4, do_sample=False, pad_token_id=pad_token_id)
+
+
+def prepare_model(model_id, warmup=False):
+    """
+    Загружает модель; в ускоренном режиме компилирует ее, и тогда прогрев обязателен
+    """
+    model, tokenizer = load_model(model_id)
+    if accel_enabled():
+        accelerate_model(model, tokenizer)
+    if warmup or is_accelerated(model):
+        warmup_model(model, tokenizer)
+    return model, tokenizer
+
+
+class ModelEntry:
+    """Загруженная модель вместе с токенизатором и метаданными"""
+
+    def __init__(self, name, model_id, model, tokenizer):
+        self.name = name
+        self.model_id = model_id
+        self.model = model
+        self.tokenizer = tokenizer
+        self.info = describe_model(model, tokenizer)
+        self.size_bytes = model_size_bytes(model)
+        self.loaded_at = time.time()
+        self.last_used = time.monotonic()
+
+    def touch(self):
+        self.last_used = time.monotonic()
+
+
+class ModelRegistry:
+    """
+    Реестр именованных моделей: ленивая загрузка, выгрузка по простою и по пределу памяти,
+    фоновая загрузка новой версии с атомарным переключением трафика.
+
+    Выгрузка только убирает модель из реестра: запросы, уже получившие ModelEntry,
+    дорабатывают на старых весах, и память освобождается после их завершения.
+    """
+
+    def __init__(self, default_alias=DEFAULT_ALIAS, idle_ttl=MODEL_IDLE_TTL_S, memory_cap_mb=MODEL_MEMORY_CAP_MB):
+        self.default_alias = default_alias
+        self.idle_ttl = idle_ttl
+        self.memory_cap_bytes = int(memory_cap_mb * 2**20)
+        self._sources = {default_alias: DEFAULT_MODEL_NAME}
+        self._allowed = {model_id.strip() for model_id in ALLOWED_MODELS.split(",") if model_id.strip()}
+        self._entries = {}
+        self._jobs = {}
+        self._lock = threading.RLock()
+        self._load_locks = {}
+        self._sweeper = None
+
+    def register(self, name, model_id):
+        """Регистрирует имя без загрузки; модель загрузится при первом обращении"""
+        with self._lock:
+            self._sources[name] = model_id
+
+    def is_allowed(self, model_id):
+        """Разрешена ли загрузка model_id по запросу извне: только зарегистрированные и из LLM_ALLOWED_MODELS"""
+        with self._lock:
+            return model_id in self._allowed or model_id in self._sources.values()
+
+    def get(self, name=None):
+        """
+        Возвращает ModelEntry по имени, загружая модель при первом обращении
+        """
+        name = name or self.default_alias
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is not None:
+                entry.touch()
+                return entry
+            if name not in self._sources:
+                raise UnknownModelError(f"Модель '{name}' не зарегистрирована")
+            load_lock = self._load_locks.setdefault(name, threading.Lock())
+
+        # Параллельные запросы к незагруженной модели ждут одну загрузку
+        with load_lock:
+            with self._lock:
+                entry = self._entries.get(name)
+                model_id = self._sources[name]
+            if entry is None:
+                logger.info(f"🔄 Ленивая загрузка модели '{name}' ({model_id})")
+                model, tokenizer = prepare_model(model_id)
+                # Пока шла загрузка, load_async мог установить новую версию — она важнее
+                entry = self._install(ModelEntry(name, model_id, model, tokenizer), replace=False)
+        entry.touch()
+        return entry
+
+    def _install(self, entry, replace=True):
+        """
+        Устанавливает entry под его именем и возвращает установленную модель.
+        replace=False — только если под этим именем еще ничего нет (ленивая загрузка)
+        """
+        with self._lock:
+            previous = self._entries.get(entry.name)
+            if previous is not None and not replace:
+                return previous
+            self._sources[entry.name] = entry.model_id
+            self._entries[entry.name] = entry
+        if previous is not None and previous is not entry:
+            logger.info(f"🔁 Трафик '{entry.name}' переключен: {previous.model_id} → {entry.model_id}")
+        self._enforce_memory_cap(keep=entry.name)
+        return entry
+
+    def load_async(self, name, model_id, warmup=True):
+        """
+        Загружает model_id в фоне и после прогрева атомарно подменяет модель с именем name.
+        Пока идёт загрузка, запросы обслуживает текущая версия.
+        """
+        with self._lock:
+            job = self._jobs.get(name)
+            if job is not None and job["status"] == "loading":
+                raise RuntimeError(f"Модель '{name}' уже загружается ({job['model_id']})")
+            self._jobs[name] = {"model_id": model_id, "status": "loading", "started_at": time.time()}
+
+        def run():
+            try:
+                model, tokenizer = prepare_model(model_id, warmup=warmup)
+                self._install(ModelEntry(name, model_id, model, tokenizer))
+                status = {"status": "ready"}
+            except Exception as e:
+                logger.error(f"❌ Фоновая загрузка '{name}' ({model_id}) не удалась: {str(e)}")
+                status = {"status": "failed", "error": str(e)}
+            with self._lock:
+                self._jobs[name].update(status, finished_at=time.time())
+
+        threading.Thread(target=run, name=f"model-load-{name}", daemon=True).start()
+        return self._jobs[name]
+
+    def unload(self, name):
+        with self._lock:
+            if name not in self._sources:
+                raise UnknownModelError(f"Модель '{name}' не зарегистрирована")
+            entry = self._entries.pop(name, None)
+        if entry is not None:
+            logger.info(f"📤 Модель '{name}' ({entry.model_id}) выгружена")
+        return entry is not None
+
+    def evict_idle(self):
+        """Выгружает модели, простаивающие дольше idle_ttl (кроме модели по умолчанию)"""
+        if self.idle_ttl <= 0:
+            return []
+        now = time.monotonic()
+        with self._lock:
+            idle = [
+                name for name, entry in self._entries.items()
+                if name != self.default_alias and now - entry.last_used > self.idle_ttl
+            ]
+        for name in idle:
+            self.unload(name)
+        return idle
+
+    def _enforce_memory_cap(self, keep):
+        if self.memory_cap_bytes <= 0:
+            return
+        with self._lock:
+            total = sum(entry.size_bytes for entry in self._entries.values())
+            candidates = sorted(
+                (entry for name, entry in self._entries.items() if name not in (keep, self.default_alias)),
+                key=lambda entry: entry.last_used
+            )
+        for entry in candidates:
+            if total <= self.memory_cap_bytes:
+                break
+            self.unload(entry.name)
+            total -= entry.size_bytes
+        if total > self.memory_cap_bytes:
+            logger.warning(f"⚠️ Модели занимают {total / 2**20:.0f} МБ при пределе {self.memory_cap_bytes / 2**20:.0f} МБ")
+
+    def start_sweeper(self, interval=30.0):
+        """Фоновая выгрузка простаивающих моделей"""
+        if self.idle_ttl <= 0 or self._sweeper is not None:
+            return
+
+        def sweep():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.evict_idle()
+                except Exception as e:
+                    logger.error(f"❌ Ошибка выгрузки простаивающих моделей: {str(e)}")
+
+        self._sweeper = threading.Thread(target=sweep, name="model-idle-sweeper", daemon=True)
+        self._sweeper.start()
+
+    def loaded(self, name=None):
+        """ModelEntry, если модель уже загружена, иначе None (без загрузки)"""
+        with self._lock:
+            return self._entries.get(name or self.default_alias)
+
+    def list(self):
+        now = time.monotonic()
+        with self._lock:
+            models = []
+            for name, model_id in self._sources.items():
+                entry = self._entries.get(name)
+                item = {"name": name, "model_id": model_id, "default": name == self.default_alias, "loaded": entry is not None}
+                if entry is not None:
+                    item.update({
+                        "loaded_model_id": entry.model_id,
+                        "size_mb": entry.size_bytes / 2**20,
+                        "idle_s": now - entry.last_used,
+                        "info": entry.info
+                    })
+                if name in self._jobs:
+                    item["job"] = dict(self._jobs[name])
+                models.append(item)
+            return {
+                "default": self.default_alias,
+                "idle_ttl_s": self.idle_ttl,
+                "memory_cap_mb": self.memory_cap_bytes / 2**20,
+                "models": models
+            }
+
+
+def _parse_models(spec):
+    models = {}
+    for item in spec.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        name, _, model_id = item.partition("=")
+        models[name.strip()] = model_id.strip() or name.strip()
+    return models
+
+
+model_registry = ModelRegistry()
+for _name, _model_id in _parse_models(EXTRA_MODELS).items():
+    model_registry.register(_name, _model_id)
@@ -0,0 +1,259 @@
+import argparse
+import glob
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from app.recorder import summarize_response
+
+# Заполнитель для редактированных текстов: длина в символах сохраняется
+FILLER = "Расскажи подробно интересный факт о природе и науке. "
+
+
+def load_records(path, limit=None):
+    """
+    Читает журнал трафика вместе с ротированными файлами (path.N … path.1, path) в порядке поступления
+    """
+    backups = [name for name in glob.glob(glob.escape(path) + ".*") if name.rsplit(".", 1)[1].isdigit()]
+    backups.sort(key=lambda name: int(name.rsplit(".", 1)[1]), reverse=True)
+    records = []
+    for name in backups + [path]:
+        try:
+            with open(name, encoding="utf-8") as f:
+                records.extend(json.loads(line) for line in f if line.strip())
+        except FileNotFoundError:
+            continue
+    records.sort(key=lambda record: record["t"])
+    return records[:limit] if limit else records
+
+
+def _synthetic_text(length):
+    repeats = length // len(FILLER) + 1
+    return (FILLER * repeats)[:length]
+
+
+def _restore_value(value):
+    if isinstance(value, dict) and value.get("redacted"):
+        return _synthetic_text(value["len"])
+    if isinstance(value, list):
+        return [_restore_value(item) for item in value]
+    return value
+
+
+def restore_body(body):
+    """Тело запроса для повторной отправки: редактированные тексты заменяются заполнителем той же длины"""
+    return {key: _restore_value(value) for key, value in (body or {}).items()}
+
+
+def _percentiles(values):
+    if not values:
+        return None
+    ordered = sorted(values)
+
+    def pick(q):
+        return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))], 2)
+
+    return {
+        "count": len(ordered),
+        "mean": round(sum(ordered) / len(ordered), 2),
+        "p50": pick(0.5),
+        "p90": pick(0.9),
+        "p99": pick(0.99),
+        "max": round(ordered[-1], 2)
+    }
+
+
+def is_redacted(body):
+    """Есть ли в теле запроса тексты, замененные хэшем (при воспроизведении — заполнитель)"""
+    if isinstance(body, dict):
+        return body.get("redacted") is True or any(is_redacted(value) for value in body.values())
+    if isinstance(body, list):
+        return any(is_redacted(item) for item in body)
+    return False
+
+
+def parse_api_keys(spec):
+    """Разбирает --api-keys "клиент=ключ,клиент2=ключ2" в {клиент: ключ} (клиент — как в LLM_API_KEYS)"""
+    keys = {}
+    for item in (spec or "").split(","):
+        item = item.strip()
+        if not item:
+            continue
+        tenant, _, api_key = item.partition("=")
+        if not tenant.strip() or not api_key.strip():
+            raise ValueError(f"Некорректная запись --api-keys: '{item}'")
+        keys[tenant.strip()] = api_key.strip()
+    return keys
+
+
+def tenant_api_key(record, api_keys):
+    """
+    API-ключ исходного клиента записи (поле tenant вида "key:клиент"); None для анонимных
+    клиентов и клиентов без ключа в api_keys
+    """
+    tenant = record.get("tenant") or ""
+    if not tenant.startswith("key:"):
+        return None
+    return api_keys.get(tenant[len("key:"):])
+
+
+def unmapped_tenants(records, api_keys):
+    """Клиенты с API-ключом, для которых не передан ключ: их запросы уходят анонимно"""
+    return sorted({
+        record["tenant"] for record in records
+        if (record.get("tenant") or "").startswith("key:") and tenant_api_key(record, api_keys) is None
+    })
+
+
+def send(url, record, timeout, scheduled, api_keys=None):
+    """
+    Отправляет один записанный запрос и возвращает статус, задержку и сводку ответа.
+    Запрос уходит с API-ключом исходного клиента из api_keys, чтобы сервер отнес его к тому же
+    клиенту и классу приоритета, что и при записи.
+    Задержка считается от запланированного момента прихода (scheduled, по perf_counter), а не от начала
+    отправки: если все потоки заняты, ожидание свободного потока входит в задержку, как очередь
+    на сервере, и отдельно видно в lag_ms.
+    """
+    headers = dict(record.get("headers", {}))
+    api_key = tenant_api_key(record, api_keys or {})
+    if api_key is not None:
+        headers["X-API-Key"] = api_key
+    started = time.perf_counter()
+    lag_ms = (started - scheduled) * 1000
+    try:
+        response = requests.post(url + record["path"], json=restore_body(record["body"]), headers=headers, timeout=timeout)
+        content = response.content
+        status = response.status_code
+        content_type = response.headers.get("content-type", "")
+    except Exception as e:
+        return {"status": None, "ms": (time.perf_counter() - scheduled) * 1000, "lag_ms": lag_ms, "error": str(e)}
+    result = {"status": status, "ms": (time.perf_counter() - scheduled) * 1000, "lag_ms": lag_ms}
+    if status == 200:
+        result["output"] = summarize_response(content_type, content)
+    return result
+
+
+def compare_outputs(records, replayed):
+    """
+    Дрейф вывода: доля точных совпадений, разница длины ответа, совпадение ранжирования.
+    Совпадения текста ожидаемы только для детерминированных запросов (скоринг, greedy).
+    Записи с редактированными текстами не сравниваются: их воспроизводят с заполнителем вместо промпта.
+    """
+    exact = []
+    length_delta = []
+    ranking = []
+    skipped_redacted = 0
+    for record, after in zip(records, replayed):
+        before = record.get("output")
+        if not before or not after:
+            continue
+        if is_redacted(record.get("body")):
+            skipped_redacted += 1
+            continue
+        if "sha" in before and "sha" in after:
+            exact.append(before["sha"] == after["sha"])
+            length_delta.append(after["len"] - before["len"])
+        if "ranking" in before and "ranking" in after:
+            ranking.append(before["ranking"] == after["ranking"])
+    report = {"compared": len(exact) + len(ranking), "skipped_redacted": skipped_redacted}
+    if exact:
+        report["exact_match_rate"] = round(sum(exact) / len(exact), 4)
+        report["length_delta"] = _percentiles(length_delta)
+    if ranking:
+        report["ranking_agreement"] = round(sum(ranking) / len(ranking), 4)
+    return report
+
+
+def replay(records, url, speed=1.0, concurrency=64, timeout=300, api_keys=None):
+    """
+    Повторяет записанный трафик с исходными интервалами между запросами, ускоренными в speed раз
+    (speed=0 — без пауз, как можно быстрее), с API-ключами исходных клиентов из api_keys
+    """
+    results = [None] * len(records)
+    if not records:
+        return results
+    start_wall = time.perf_counter()
+    first = records[0]["t"]
+    lock = threading.Lock()
+
+    def run(index, record, scheduled):
+        result = send(url, record, timeout, scheduled, api_keys)
+        with lock:
+            results[index] = result
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for index, record in enumerate(records):
+            scheduled = time.perf_counter()
+            if speed > 0:
+                scheduled = start_wall + (record["t"] - first) / speed
+                delay = scheduled - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            pool.submit(run, index, record, scheduled)
+    return results
+
+
+def build_report(records, results, speed, elapsed_s):
+    report = {"requests": len(records), "speed": speed, "elapsed_s": round(elapsed_s, 1), "paths": {}}
+    for path in sorted({record["path"] for record in records}):
+        pairs = [(record, result) for record, result in zip(records, results) if record["path"] == path]
+        recorded_status = {}
+        replayed_status = {}
+        for record, result in pairs:
+            recorded_status[str(record["status"])] = recorded_status.get(str(record["status"]), 0) + 1
+            replayed_status[str(result["status"])] = replayed_status.get(str(result["status"]), 0) + 1
+        report["paths"][path] = {
+            "latency_ms": {
+                "recorded": _percentiles([record["ms"] for record, _ in pairs if record["status"] == 200]),
+                "replayed": _percentiles([result["ms"] for _, result in pairs if result["status"] == 200])
+            },
+            # Ожидание свободного потока клиента: если велико, увеличьте --concurrency
+            "dispatch_lag_ms": _percentiles([result["lag_ms"] for _, result in pairs]),
+            "status": {"recorded": recorded_status, "replayed": replayed_status},
+            "output_drift": compare_outputs(
+                [record for record, _ in pairs],
+                [result.get("output") for _, result in pairs]
+            )
+        }
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Воспроизведение записанного трафика и сравнение задержек и вывода")
+    parser.add_argument("log", help="Журнал трафика (LLM_RECORD_PATH)")
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--speed", type=float, default=1.0, help="Во сколько раз ускорить поток запросов (0 — без пауз)")
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--limit", type=int, default=None)
+    parser.add_argument("--timeout", type=float, default=300)
+    parser.add_argument("--output", default=None, help="Куда сохранить отчет в JSON")
+    parser.add_argument(
+        "--api-keys", default=os.environ.get("LLM_REPLAY_API_KEYS", ""),
+        help="Ключи исходных клиентов \"клиент=ключ,...\": запросы повторяются от их имени и с их приоритетом"
+    )
+    args = parser.parse_args()
+
+    try:
+        api_keys = parse_api_keys(args.api_keys)
+    except ValueError as e:
+        parser.error(str(e))
+    records = load_records(args.log, args.limit)
+    started = time.perf_counter()
+    results = replay(records, args.url.rstrip("/"), args.speed, args.concurrency, args.timeout, api_keys)
+    report = build_report(records, results, args.speed, time.perf_counter() - started)
+    # Запросы этих клиентов ушли без ключа: сервер отнес их к одному анонимному клиенту
+    report["unmapped_tenants"] = unmapped_tenants(records, api_keys)
+
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,314 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+
+# Классы приоритета от высшего к низшему
+PRIORITY_CLASSES = ("interactive", "default", "batch")
+DEFAULT_PRIORITY = os.environ.get("LLM_DEFAULT_PRIORITY", "default")
+
+# Сколько запросов одновременно выполняют модель
+MAX_CONCURRENCY = int(os.environ.get("LLM_MAX_CONCURRENCY", "2"))
+# Ограничения на одного клиента; 0 — без ограничения
+TENANT_MAX_CONCURRENCY = int(os.environ.get("LLM_TENANT_MAX_CONCURRENCY", "0"))
+TENANT_MAX_QUEUED = int(os.environ.get("LLM_TENANT_MAX_QUEUED", "0"))
+TENANT_RATE_LIMIT = float(os.environ.get("LLM_TENANT_RATE_LIMIT", "0"))
+TENANT_RATE_BURST = float(os.environ.get("LLM_TENANT_RATE_BURST", "10"))
+# Сколько запросов всего может ждать в очереди: каждый ожидающий занимает поток пула, поэтому
+# очередь должна быть меньше LLM_THREADPOOL_SIZE. Низшие классы могут занять только часть очереди
+MAX_QUEUED = int(os.environ.get("LLM_MAX_QUEUED", "128"))
+# Сколько запрос может ждать в очереди
+QUEUE_TIMEOUT_S = float(os.environ.get("LLM_QUEUE_TIMEOUT_S", "120"))
+# Известные клиенты: "ключ=клиент:наивысший_класс,ключ2=клиент2" (класс по умолчанию — DEFAULT_PRIORITY)
+API_KEYS = os.environ.get("LLM_API_KEYS", "")
+# Наивысший класс для запросов без известного API-ключа (клиент — адрес запроса)
+ANONYMOUS_MAX_PRIORITY = os.environ.get("LLM_ANONYMOUS_MAX_PRIORITY", "default")
+
+WAIT_SAMPLES = 1000
+# Как часто удалять корзины лимита простаивающих клиентов
+BUCKET_PRUNE_INTERVAL_S = 60.0
+
+
+class SchedulerRejected(Exception):
+    """Запрос не допущен планировщиком"""
+
+    status_code = 503
+    retry_after = 5
+
+
+class RateLimitExceeded(SchedulerRejected):
+    status_code = 429
+    retry_after = 1
+
+
+class QueueFull(SchedulerRejected):
+    status_code = 429
+
+
+class QueueTimeout(SchedulerRejected):
+    status_code = 503
+
+
+def key_hash(api_key):
+    return hashlib.sha256(api_key.encode("utf-8")).hexdigest()
+
+
+def parse_api_keys(spec):
+    """Разбирает LLM_API_KEYS в {sha256 ключа: (клиент, наивысший класс)}"""
+    keys = {}
+    for item in spec.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        api_key, _, tenant = item.partition("=")
+        tenant, _, ceiling = tenant.partition(":")
+        ceiling = ceiling.strip() or DEFAULT_PRIORITY
+        if not api_key.strip() or not tenant.strip() or ceiling not in PRIORITY_CLASSES:
+            raise ValueError(f"Некорректная запись LLM_API_KEYS для клиента '{tenant.strip()}'")
+        keys[key_hash(api_key.strip())] = (tenant.strip(), ceiling)
+    return keys
+
+
+_api_keys = parse_api_keys(API_KEYS)
+
+
+def api_key_tenant(api_key):
+    """Клиент и наивысший разрешенный класс по API-ключу; None, если ключ не задан или неизвестен"""
+    if not api_key:
+        return None
+    return _api_keys.get(key_hash(api_key))
+
+
+def cap_priority(priority, ceiling):
+    """Понижает запрошенный класс до наивысшего разрешенного клиенту"""
+    return PRIORITY_CLASSES[max(PRIORITY_CLASSES.index(priority), PRIORITY_CLASSES.index(ceiling))]
+
+
+class _Ticket:
+    def __init__(self, tenant, priority):
+        self.tenant = tenant
+        self.priority = priority
+        self.enqueued = time.monotonic()
+        self.wait_s = 0.0
+        self.granted = False
+        self.event = threading.Event()
+
+
+class _TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.capacity = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class _ClassStats:
+    def __init__(self):
+        self.admitted = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self.active = 0
+        self.waits = deque(maxlen=WAIT_SAMPLES)
+
+
+def _percentile(values, q):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class FairScheduler:
+    """
+    Допуск запросов к модели: строгий приоритет между классами, а внутри класса —
+    круговая очередь по клиентам, чтобы один клиент с тысячами запросов не вытеснял остальных.
+    Низший класс получает слоты, только когда очереди высших классов пусты.
+    """
+
+    def __init__(self, max_concurrency=MAX_CONCURRENCY, max_queued=MAX_QUEUED, tenant_max_concurrency=TENANT_MAX_CONCURRENCY,
+                 tenant_max_queued=TENANT_MAX_QUEUED, tenant_rate_limit=TENANT_RATE_LIMIT,
+                 tenant_rate_burst=TENANT_RATE_BURST, queue_timeout=QUEUE_TIMEOUT_S):
+        self.max_concurrency = max_concurrency
+        self.max_queued = max_queued
+        self.tenant_max_concurrency = tenant_max_concurrency
+        self.tenant_max_queued = tenant_max_queued
+        self.tenant_rate_limit = tenant_rate_limit
+        self.tenant_rate_burst = tenant_rate_burst
+        self.queue_timeout = queue_timeout
+
+        self.active = 0
+        self.queued = 0
+        self._queues = {priority: OrderedDict() for priority in PRIORITY_CLASSES}
+        self._tenant_active = {}
+        self._tenant_queued = {}
+        self._buckets = {}
+        self._buckets_pruned = time.monotonic()
+        self._stats = {priority: _ClassStats() for priority in PRIORITY_CLASSES}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def slot(self, tenant, priority=DEFAULT_PRIORITY):
+        """
+        Ждет слот выполнения для клиента tenant в классе priority; возвращает билет с временем ожидания
+        """
+        if priority not in PRIORITY_CLASSES:
+            raise ValueError(f"priority должен быть одним из {PRIORITY_CLASSES}")
+        ticket = self._enqueue(tenant, priority)
+        if not ticket.event.wait(self.queue_timeout):
+            self._cancel(ticket)
+        try:
+            yield ticket
+        finally:
+            self._release(ticket)
+
+    def _enqueue(self, tenant, priority):
+        with self._lock:
+            stats = self._stats[priority]
+            if self.tenant_rate_limit > 0:
+                self._prune_buckets()
+                bucket = self._buckets.get(tenant)
+                if bucket is None:
+                    bucket = self._buckets[tenant] = _TokenBucket(self.tenant_rate_limit, self.tenant_rate_burst)
+                if not bucket.take():
+                    stats.rejected += 1
+                    raise RateLimitExceeded(f"Превышен лимит запросов клиента {tenant}")
+            limit = self.class_queue_limit(priority)
+            if self.queued >= limit:
+                stats.rejected += 1
+                raise QueueFull(f"Очередь класса {priority} заполнена ({limit} запросов)")
+            queued = self._tenant_queued.get(tenant, 0)
+            if self.tenant_max_queued and queued >= self.tenant_max_queued:
+                stats.rejected += 1
+                raise QueueFull(f"У клиента {tenant} уже {queued} запросов в очереди")
+
+            ticket = _Ticket(tenant, priority)
+            self._queues[priority].setdefault(tenant, deque()).append(ticket)
+            self._tenant_queued[tenant] = queued + 1
+            self.queued += 1
+            self._dispatch()
+            return ticket
+
+    def class_queue_limit(self, priority):
+        """
+        Сколько запросов может стоять в очереди, чтобы запрос класса priority еще был принят:
+        interactive — вся очередь, каждый следующий класс — меньшая доля, чтобы массовые клиенты
+        не занимали места, нужные интерактивным запросам
+        """
+        share = len(PRIORITY_CLASSES) - PRIORITY_CLASSES.index(priority)
+        return max(1, self.max_queued * share // len(PRIORITY_CLASSES))
+
+    def _prune_buckets(self):
+        """Удаляет корзины, которые успели наполниться: для клиента они не отличаются от новых"""
+        now = time.monotonic()
+        if now - self._buckets_pruned < BUCKET_PRUNE_INTERVAL_S:
+            return
+        self._buckets_pruned = now
+        for tenant, bucket in list(self._buckets.items()):
+            if bucket.tokens + (now - bucket.updated) * bucket.rate >= bucket.capacity:
+                del self._buckets[tenant]
+
+    def _cancel(self, ticket):
+        with self._lock:
+            # Слот мог быть выдан между таймаутом и захватом блокировки
+            if ticket.granted:
+                return
+            queue = self._queues[ticket.priority].get(ticket.tenant)
+            if queue is not None:
+                queue.remove(ticket)
+                if not queue:
+                    del self._queues[ticket.priority][ticket.tenant]
+            self._decrement(self._tenant_queued, ticket.tenant)
+            self.queued -= 1
+            self._stats[ticket.priority].timeouts += 1
+        raise QueueTimeout(f"Запрос ждал слот дольше {self.queue_timeout:g} с")
+
+    def _release(self, ticket):
+        with self._lock:
+            self.active -= 1
+            self._decrement(self._tenant_active, ticket.tenant)
+            self._stats[ticket.priority].active -= 1
+            self._dispatch()
+
+    @staticmethod
+    def _decrement(counters, tenant):
+        counters[tenant] -= 1
+        if counters[tenant] <= 0:
+            del counters[tenant]
+
+    def _next_ticket(self):
+        for priority in PRIORITY_CLASSES:
+            tenants = self._queues[priority]
+            for tenant in list(tenants):
+                if self.tenant_max_concurrency and self._tenant_active.get(tenant, 0) >= self.tenant_max_concurrency:
+                    continue
+                queue = tenants.pop(tenant)
+                ticket = queue.popleft()
+                # Клиент уходит в конец круга своего класса
+                if queue:
+                    tenants[tenant] = queue
+                return ticket
+        return None
+
+    def _dispatch(self):
+        while self.active < self.max_concurrency:
+            ticket = self._next_ticket()
+            if ticket is None:
+                return
+            ticket.granted = True
+            ticket.wait_s = time.monotonic() - ticket.enqueued
+            self.active += 1
+            self._tenant_active[ticket.tenant] = self._tenant_active.get(ticket.tenant, 0) + 1
+            self._decrement(self._tenant_queued, ticket.tenant)
+            self.queued -= 1
+            stats = self._stats[ticket.priority]
+            stats.active += 1
+            stats.admitted += 1
+            stats.waits.append(ticket.wait_s)
+            ticket.event.set()
+
+    def metrics(self):
+        with self._lock:
+            classes = {}
+            for priority in PRIORITY_CLASSES:
+                stats = self._stats[priority]
+                waits = list(stats.waits)
+                classes[priority] = {
+                    "queued": sum(len(queue) for queue in self._queues[priority].values()),
+                    "queued_tenants": len(self._queues[priority]),
+                    "queue_limit": self.class_queue_limit(priority),
+                    "active": stats.active,
+                    "admitted_total": stats.admitted,
+                    "rejected_total": stats.rejected,
+                    "timeouts_total": stats.timeouts,
+                    "wait_ms_p50": None if not waits else round(_percentile(waits, 0.5) * 1000, 2),
+                    "wait_ms_p95": None if not waits else round(_percentile(waits, 0.95) * 1000, 2),
+                    "wait_ms_p99": None if not waits else round(_percentile(waits, 0.99) * 1000, 2)
+                }
+            return {
+                "max_concurrency": self.max_concurrency,
+                "active": self.active,
+                "max_queued": self.max_queued,
+                "queued": self.queued,
+                "rate_buckets": len(self._buckets),
+                "tenant_limits": {
+                    "max_concurrency": self.tenant_max_concurrency,
+                    "max_queued": self.tenant_max_queued,
+                    "rate_limit_per_s": self.tenant_rate_limit,
+                    "rate_burst": self.tenant_rate_burst
+                },
+                "classes": classes
+            }
+
+
+scheduler = FairScheduler()
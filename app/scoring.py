@@ -0,0 +1,101 @@
+from contextlib import nullcontext
+
+import torch
+
+from app.accel import eager_forward
+
+SCORE_MAX_CANDIDATES = 64
+# Промпт длиннее обрезается слева (как и в /generate, не больше 2048 токенов)
+SCORE_MAX_PROMPT_TOKENS = 2048
+SCORE_MAX_CONTINUATION_TOKENS = 256
+
+
+def _expand_cache(past_key_values, repeats):
+    """
+    Повторяет KV-кэш промпта для каждого кандидата (префикс считается один раз)
+    """
+    if hasattr(past_key_values, "batch_repeat_interleave"):
+        past_key_values.batch_repeat_interleave(repeats)
+        return past_key_values
+    return tuple(
+        tuple(tensor.repeat_interleave(repeats, dim=0) for tensor in layer)
+        for layer in past_key_values
+    )
+
+
+def score_continuations(model, tokenizer, prompt, continuations, reserve=None):
+    """
+    Лог-вероятности продолжений при заданном промпте без генерации.
+    Один прямой проход по промпту (prefill) и один батчевый проход по всем кандидатам
+    поверх общего KV-кэша префикса.
+    reserve(batch_size, total_tokens, logits_positions, prefill_logits_positions) — необязательный допуск по памяти
+    """
+    prompt_ids = tokenizer(prompt, return_tensors="pt")["input_ids"]
+    if prompt_ids.shape[1] == 0:
+        raise ValueError("Промпт не содержит токенов")
+    # Продолжение зависит от конца промпта, поэтому сохраняются последние токены
+    prompt_ids = prompt_ids[:, -SCORE_MAX_PROMPT_TOKENS:]
+
+    cont_ids = [tokenizer(text, add_special_tokens=False)["input_ids"] for text in continuations]
+    if any(len(ids) == 0 for ids in cont_ids):
+        raise ValueError("Каждое продолжение должно содержать хотя бы один токен")
+    if any(len(ids) > SCORE_MAX_CONTINUATION_TOKENS for ids in cont_ids):
+        raise ValueError(f"Продолжение длиннее {SCORE_MAX_CONTINUATION_TOKENS} токенов")
+
+    device = model.device
+    pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+    n = len(cont_ids)
+    prompt_len = prompt_ids.shape[1]
+    max_len = max(len(ids) for ids in cont_ids)
+
+    # Кандидаты дополняются справа, чтобы позиции совпадали с продолжением промпта
+    batch_ids = torch.full((n, max_len), pad_token_id, dtype=torch.long)
+    batch_mask = torch.zeros((n, max_len), dtype=torch.long)
+    for i, ids in enumerate(cont_ids):
+        batch_ids[i, :len(ids)] = torch.tensor(ids, dtype=torch.long)
+        batch_mask[i, :len(ids)] = 1
+
+    forward = eager_forward(model)
+    # Логиты prefill (одна позиция) считаются вместе с логитами кандидатов
+    with reserve(n, prompt_len + max_len, max_len, 1) if reserve is not None else nullcontext(), torch.no_grad():
+        # Логиты нужны только для последней позиции промпта, а не prompt_len × vocab
+        prefill = forward(input_ids=prompt_ids.to(device), use_cache=True, logits_to_keep=1)
+        first_logprobs = torch.log_softmax(prefill.logits[0, -1].float(), dim=-1)
+        past_key_values = prefill.past_key_values
+        del prefill
+
+        attention_mask = torch.cat([torch.ones((n, prompt_len), dtype=torch.long), batch_mask], dim=1)
+        position_ids = torch.arange(prompt_len, prompt_len + max_len, dtype=torch.long).unsqueeze(0).expand(n, -1)
+        outputs = forward(
+            input_ids=batch_ids.to(device),
+            attention_mask=attention_mask.to(device),
+            position_ids=position_ids.to(device),
+            past_key_values=_expand_cache(past_key_values, n),
+            use_cache=False
+        )
+
+        results = []
+        for i, ids in enumerate(cont_ids):
+            length = len(ids)
+            targets = torch.tensor(ids, dtype=torch.long, device=device)
+            # Токен j предсказывается логитами позиции j-1; первый — последним логитом промпта
+            token_logprobs = [first_logprobs[targets[0]]]
+            if length > 1:
+                logprobs = torch.log_softmax(outputs.logits[i, :length - 1].float(), dim=-1)
+                token_logprobs.extend(logprobs.gather(-1, targets[1:].unsqueeze(-1)).squeeze(-1))
+            token_logprobs = torch.stack(token_logprobs).cpu()
+
+            total = float(token_logprobs.sum())
+            results.append({
+                "index": i,
+                "text": continuations[i],
+                "total_logprob": total,
+                "mean_logprob": total / length,
+                "num_tokens": length,
+                "tokens": [
+                    {"token": tokenizer.decode([token_id]), "logprob": float(lp)}
+                    for token_id, lp in zip(ids, token_logprobs)
+                ]
+            })
+
+    return {"prompt_tokens": prompt_len, "candidates": results}
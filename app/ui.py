@@ -4,13 +4,16 @@ import time
 import os
 import traceback
 import logging
+from app.logging_config import setup_logging
 
 # Настройка логирования
-logging.basicConfig(level=logging.INFO)
+setup_logging()
 logger = logging.getLogger(__name__)
 
 # API URL
 API_URL = "http://api:8000" if os.environ.get("DOCKER_ENV") else "http://localhost:8000"
+# Ключ UI из LLM_API_KEYS на сервере (например, "ключ=gradio-ui:interactive")
+UI_API_KEY = os.environ.get("LLM_UI_API_KEY", "")
 
 def get_api_status():
     """Получение детального статуса API"""
@@ -71,23 +74,20 @@ def generate_text(prompt, system_prompt="Вы - полезный ассисте
     if not prompt.strip():
         return "⚠️ Пожалуйста, введите текст для генерации"
     
-    logger.info(f"📝 Генерация для: {prompt[:50]}...")
-    
     try:
-        logger.info("🌐 Отправка запроса к API...")
-        
         response = requests.post(
             f"{API_URL}/generate", 
             json={
                 "text": prompt,
                 "system_prompt": system_prompt
             },
+            # Запросы из UI идут вне очереди пакетных заданий, если ключ UI разрешает класс interactive
+            headers={"X-Priority": "interactive", "X-API-Key": UI_API_KEY},
             timeout=60
         )
         
         if response.status_code == 200:
             result = response.json()
-            logger.info("✅ Генерация успешна")
             return f"🤖 **Ответ модели:** {result['response']}\n\n📊 Статистика:\n- Длина входа: {result.get('input_length', 'unknown')}\n- Длина выхода: {result.get('output_length', 'unknown')}"
         else:
             error_msg = f"❌ Ошибка API: {response.status_code}"
@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+"""
+Тесты ограниченного JSON-схемой декодирования (app/guided.py) без загрузки модели:
+байтовый ДКА по ключевым словам схемы, маски токенов на маленьком byte-level словаре
+и logits processor. Запуск: python -m pytest test_guided.py
+"""
+
+import pytest
+import torch
+
+from app.guided import (
+    DEAD, _BYTE_DECODER, ByteDFA, JSONSchemaLogitsProcessor, SchemaGuide, _bytes_to_unicode, get_guide,
+    schema_from_response_format, schema_to_grammar
+)
+
+_BYTE_ENCODER = _bytes_to_unicode()
+
+
+class FakeByteLevelTokenizer:
+    """Минимальный byte-level BPE токенизатор: все 256 байтов плюс несколько слияний"""
+
+    MERGES = [b'{"', b'":', b'": ', b'", "', b'"}', b' "', b"true", b"false", b"null", b"12", b"3.5",
+              b"[1", b", ", b"]}", b"abc", b"\xd0\x9f", b"\xd0\x9f\xd1\x80"]
+
+    def __init__(self):
+        pieces = [bytes([byte]) for byte in range(256)] + self.MERGES
+        self.vocab = {"".join(_BYTE_ENCODER[byte] for byte in piece): i for i, piece in enumerate(pieces)}
+        self.eos_token_id = len(self.vocab)
+        self.vocab["<|endoftext|>"] = self.eos_token_id
+        self.all_special_ids = [self.eos_token_id]
+
+    def get_vocab(self):
+        return dict(self.vocab)
+
+    def get_added_vocab(self):
+        return {"<|endoftext|>": self.eos_token_id}
+
+    def __len__(self):
+        return len(self.vocab)
+
+    def encode(self, data):
+        """Жадная токенизация байтов самыми длинными кусками словаря"""
+        by_bytes = {bytes(_decode(token)): token_id for token, token_id in self.vocab.items() if token_id != self.eos_token_id}
+        ids = []
+        while data:
+            for length in range(len(data), 0, -1):
+                if data[:length] in by_bytes:
+                    ids.append(by_bytes[data[:length]])
+                    data = data[length:]
+                    break
+        return ids
+
+
+def _decode(token):
+    return bytes(_BYTE_DECODER[char] for char in token)
+
+
+def accepts(schema, text):
+    dfa = ByteDFA(schema_to_grammar(schema))
+    return dfa.is_accepting(dfa.walk(dfa.initial, text.encode("utf-8")))
+
+
+@pytest.mark.parametrize("schema, valid, invalid", [
+    ({"type": "string"}, ['"abc"', '""', '"Привет"', '"a\\"b"', '"\\u0041"'], ['abc', '"a', '"a"b"', '1']),
+    ({"type": "integer"}, ["0", "-12", "42"], ["01", "1.5", "-", '"1"']),
+    ({"type": "number"}, ["0", "-1.5", "3e10", "2.5E-3"], ["1.", ".5", "1e", "+1"]),
+    ({"type": "boolean"}, ["true", "false"], ["True", "1", "null"]),
+    ({"type": "null"}, ["null"], ["None", ""]),
+    ({"type": ["integer", "null"]}, ["1", "null"], ['"1"', "true"]),
+    ({"type": "object", "properties": {"a": {"type": "integer"}, "b": {"type": "string"}}},
+     ['{"a":1,"b":"x"}', '{"a": 1, "b": "x"}'], ['{"b":"x","a":1}', '{"a":1}', '{"a":"1","b":"x"}']),
+    ({"type": "array", "items": {"type": "number"}}, ["[]", "[1]", "[1, 2.5,3]"], ["[1,]", "[,]", "[", '["a"]']),
+    ({"type": "array", "items": {"type": "number"}, "minItems": 2}, ["[1,2]", "[1, 2, 3]"], ["[]", "[1]", "[1,2,]"]),
+    ({"enum": ["red", 1, None]}, ['"red"', "1", "null"], ['"blue"', "2", '"1"']),
+    ({"const": {"k": [1, 2]}}, ['{"k": [1, 2]}'], ['{"k":[1,2]}', '{"k": [2, 1]}']),
+    ({"anyOf": [{"type": "string"}, {"type": "integer"}]}, ['"a"', "7"], ["true", "1.5"]),
+    ({"oneOf": [{"type": "boolean"}, {"type": "null"}]}, ["true", "null"], ['"true"']),
+    ({"allOf": [{"type": "integer"}]}, ["5"], ["5.0"]),
+    ({}, ['"a"', "1", "[1, {}]", '{"a": null}'], ["", "[1,]"]),
+])
+def test_schema_keywords(schema, valid, invalid):
+    for text in valid:
+        assert accepts(schema, text), text
+    for text in invalid:
+        assert not accepts(schema, text), text
+
+
+def test_json_object_allows_nesting():
+    schema = schema_from_response_format({"type": "json_object"})
+    assert accepts(schema, '{"a":{"b":[1,2,{"c":null}]}}')
+    assert accepts(schema, "{}")
+    assert not accepts(schema, "[]")
+    assert not accepts(schema, '"a"')
+
+
+@pytest.mark.parametrize("schema", [
+    {"type": "object", "properties": [1]},
+    {"enum": 5},
+    {"enum": []},
+    {"anyOf": []},
+    {"oneOf": "x"},
+    {"allOf": [{"type": "string"}, {"type": "integer"}]},
+    {"type": []},
+    {"type": "date"},
+    {"type": "array", "items": 5},
+    {"type": "array", "minItems": -1},
+    {"type": "array", "minItems": 1.5},
+    {"$ref": "#/definitions/a"},
+    [],
+])
+def test_invalid_schema(schema):
+    with pytest.raises(ValueError):
+        schema_to_grammar(schema)
+
+
+def _nested_arrays(levels, min_items):
+    schema = {"type": "string"}
+    for _ in range(levels):
+        schema = {"type": "array", "items": schema, "minItems": min_items}
+    return schema
+
+
+@pytest.mark.parametrize("schema", [
+    _nested_arrays(4, 32),
+    {"anyOf": [{"const": i} for i in range(65)]},
+])
+def test_oversized_schema(schema):
+    with pytest.raises(ValueError):
+        ByteDFA(schema_to_grammar(schema))
+
+
+@pytest.mark.parametrize("response_format", [
+    "json",
+    {"type": "json_schema", "json_schema": "x"},
+    {"type": "json_schema", "json_schema": {}},
+])
+def test_invalid_response_format(response_format):
+    with pytest.raises(ValueError):
+        schema_from_response_format(response_format)
+
+
+def test_response_format_variants():
+    schema = {"type": "string"}
+    assert schema_from_response_format({"type": "json_schema", "json_schema": {"schema": schema}}) == schema
+    assert schema_from_response_format({"type": "json_schema", "schema": schema}) == schema
+    assert schema_from_response_format(schema) == schema
+
+
+def test_vocabulary_decodes_byte_level_tokens():
+    tokenizer = FakeByteLevelTokenizer()
+    guide = SchemaGuide({"type": "string"}, tokenizer)
+    decoded = set(guide.vocabulary.token_bytes.values())
+    assert b' "' in decoded
+    assert b"\xd0\x9f\xd1\x80" in decoded
+    assert tokenizer.eos_token_id not in guide.vocabulary.token_bytes
+
+
+@pytest.mark.parametrize("schema, prefixes", [
+    ({"type": "object", "properties": {"ok": {"type": "boolean"}, "n": {"type": "integer"}}},
+     ["", '{"', '{"ok": ', '{"ok": tr', '{"ok": true, "n": 1', '{"ok": true, "n": 12}']),
+    ({"type": "array", "items": {"type": "string"}, "minItems": 1}, ["", "[", '["П', '["abc"', '["abc", ']),
+    ({"enum": ["abc", 12, None]}, ["", '"a', "1", "nu"]),
+])
+def test_masks_match_brute_force(schema, prefixes):
+    tokenizer = FakeByteLevelTokenizer()
+    guide = SchemaGuide(schema, tokenizer)
+    for prefix in prefixes:
+        state = guide.dfa.walk(guide.dfa.initial, prefix.encode("utf-8"))
+        assert state != DEAD, prefix
+        expected = {
+            token_id for token_id, data in guide.vocabulary.token_bytes.items()
+            if guide.dfa.walk(state, data) != DEAD
+        }
+        if guide.dfa.is_accepting(state):
+            expected.add(tokenizer.eos_token_id)
+        assert set(guide.allowed_tokens(state)) == expected, prefix
+
+        mask = guide.mask(state, len(tokenizer), "cpu")
+        assert set(torch.nonzero(mask).flatten().tolist()) == expected, prefix
+
+
+def test_logits_processor_tracks_generated_tokens():
+    tokenizer = FakeByteLevelTokenizer()
+    schema = {"type": "object", "properties": {"ok": {"type": "boolean"}}}
+    guide = SchemaGuide(schema, tokenizer)
+    processor = JSONSchemaLogitsProcessor(guide)
+    prompt = torch.tensor([[1, 2, 3], [4, 5, 6]])
+
+    scores = processor(prompt, torch.zeros(2, len(tokenizer)))
+    allowed = set(torch.nonzero(scores[0] > float("-inf")).flatten().tolist())
+    assert allowed == set(guide.allowed_tokens(guide.dfa.initial))
+    assert tokenizer.encode(b"{")[0] in allowed
+    assert tokenizer.encode(b"[")[0] not in allowed
+
+    # Первая строка дописывает объект до конца, вторая уходит в недопустимое состояние
+    complete = tokenizer.encode(b'{"ok": true}')
+    invalid = tokenizer.encode(b"[") * len(complete)
+    generated = torch.cat([prompt, torch.tensor([complete, invalid])], dim=1)
+    scores = processor(generated, torch.zeros(2, len(tokenizer)))
+    assert torch.nonzero(scores[0] > float("-inf")).flatten().tolist() == [tokenizer.eos_token_id]
+    assert torch.nonzero(scores[1] > float("-inf")).flatten().tolist() == [tokenizer.eos_token_id]
+
+
+def test_guide_cache_is_per_tokenizer():
+    first, second = FakeByteLevelTokenizer(), FakeByteLevelTokenizer()
+    schema = {"type": "object", "properties": {"a": {"type": "integer"}}}
+    assert get_guide(schema, first) is get_guide(dict(schema), first)
+    assert get_guide(schema, first) is not get_guide(schema, second)